@@ -0,0 +1,9 @@
+# Shared modules (se2, deskew, raycast, tiled_grid, office_loop) live one
+# level up in desktop_code/. Importing this module makes them importable;
+# the directory is appended, so it never shadows modules found first.
+import os
+import sys
+
+DESKTOP_CODE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if DESKTOP_CODE not in sys.path:
+    sys.path.append(DESKTOP_CODE)
@@ -1,9 +1,19 @@
 # process data and save for use by slam program
+# Saved headings are wrapped to [-pi, pi) (files written before se2 kept
+# the odometer's unwrapped heading; slam.py treats both the same)
 
 import numpy as np
 import os
 import pickle
 
+import desktop_path  # noqa: F401 (puts desktop_code/ on sys.path)
+import se2
+from deskew import deskew, pose_at
+
+# Motion-compensate each scan to its mid-scan pose. Angles are taken as
+# slam.LidarScan reads them, i.e. a beam points at heading h + angle
+DESKEW = True
+
 
 def load_data(filename="scan_data.pkl"):
     """Loads and deserializes an OGM instance from a binary file."""
@@ -23,17 +33,10 @@ def sync_pose(robot_scan, robot_pose):
     robot_pose: {"x": , "y": , "h": , "t": , "xr": , "yr": , "hr": } dict
     Return estimated pose at time of mid-scan
     """
-    # Find time difference between mid-scan and pose
-    mid_scan_idx = len(robot_scan) // 2
-    mid_scan_time = robot_scan[mid_scan_idx]['t']
-    pose_time = robot_pose["t"]
-    time_diff = mid_scan_time - pose_time
-
     # Estimate pose value at time of mid-scan
-    rx = robot_pose["x"] + robot_pose["xr"] * time_diff
-    ry = robot_pose["y"] + robot_pose["yr"] * time_diff
-    ryaw = robot_pose["h"] + robot_pose["hr"] * time_diff
-    return rx, ry, ryaw
+    mid_scan_idx = len(robot_scan) // 2
+    rx, ry, ryaw = pose_at(robot_pose, robot_scan[mid_scan_idx]['t'])
+    return rx, ry, float(se2.normalize_angle(ryaw))
 
 
 if __name__ == "__main__":
@@ -58,11 +61,15 @@ if __name__ == "__main__":
         prev_pose = synced_pose
         print()
         
-        # Collect angles and ranges
-        scandict = {scan['a']: scan['d']
+        # Collect angles and ranges (and times, for deskewing)
+        scandict = {scan['a']: (scan['d'], scan['t'])
                     for scan in robot_scan}
         angles = np.array(list(scandict.keys()))
-        ranges = np.array(list(scandict.values()))
+        ranges = np.array([d for d, _ in scandict.values()])
+        if DESKEW:
+            times = np.array([t for _, t in scandict.values()])
+            angles, ranges, _ = deskew(robot_pose, angles, ranges, times,
+                                       ref_time=robot_scan[len(robot_scan) // 2]['t'])
         poses.append(synced_pose)
         all_angles.extend(angles)
         all_ranges.extend(ranges)
@@ -1,48 +1,71 @@
+import itertools
+import math
+import time
+import weakref
 import numpy as np
 from dataclasses import dataclass
-from typing import List, Tuple, Optional, Dict
+from typing import Callable, List, Tuple, Optional, Dict
 import matplotlib.pyplot as plt
-from scipy.optimize import least_squares
+from scipy.sparse import coo_matrix, csr_matrix, diags
+from scipy.sparse.linalg import spsolve
 from scipy.spatial import KDTree
-from collections import defaultdict
+from scipy.ndimage import distance_transform_edt
+from collections import OrderedDict, defaultdict, deque
+from collections.abc import Sequence
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import desktop_path  # noqa: F401 (puts desktop_code/ on sys.path)
+from raycast import BatchRayCaster, shared_ray_templates
+import se2
+from tiled_grid import TiledGrid, CachedView, FixedPoint
+from office_loop.slam_front_end import point_to_line_icp, estimate_normals, ScanDownsampler
 
 @dataclass
 class Pose2D:
     """Represents a 2D pose with x, y position and theta orientation"""
+    __slots__ = ('x', 'y', 'theta')
     x: float
     y: float
     theta: float
     
     def to_matrix(self) -> np.ndarray:
         """Convert to homogeneous transformation matrix"""
-        c = np.cos(self.theta)
-        s = np.sin(self.theta)
-        return np.array([
-            [c, -s, self.x],
-            [s, c, self.y],
-            [0, 0, 1]
-        ])
+        return se2.to_matrix(self.to_vector())
     
     @staticmethod
     def from_matrix(matrix: np.ndarray) -> 'Pose2D':
         """Create pose from transformation matrix"""
         x = matrix[0, 2]
         y = matrix[1, 2]
-        theta = np.arctan2(matrix[1, 0], matrix[0, 0])
+        theta = math.atan2(matrix[1, 0], matrix[0, 0])
         return Pose2D(x, y, theta)
     
     def inverse(self) -> 'Pose2D':
         """Compute inverse pose"""
-        c = np.cos(self.theta)
-        s = np.sin(self.theta)
+        c = math.cos(self.theta)
+        s = math.sin(self.theta)
         x_inv = -c * self.x - s * self.y
         y_inv = s * self.x - c * self.y
         return Pose2D(x_inv, y_inv, -self.theta)
     
     def compose(self, other: 'Pose2D') -> 'Pose2D':
         """Compose two poses (self * other)"""
-        result = self.to_matrix() @ other.to_matrix()
-        return Pose2D.from_matrix(result)
+        # Scalar closed form of se2.compose, cheaper than numpy for one pose
+        c = math.cos(self.theta)
+        s = math.sin(self.theta)
+        theta = (self.theta + other.theta + math.pi) % (2 * math.pi) - math.pi
+        return Pose2D(self.x + c * other.x - s * other.y,
+                      self.y + s * other.x + c * other.y, theta)
+    
+    def relative_to(self, other: 'Pose2D') -> 'Pose2D':
+        """This pose in other's frame (other.inverse().compose(self))"""
+        c = math.cos(other.theta)
+        s = math.sin(other.theta)
+        dx = self.x - other.x
+        dy = self.y - other.y
+        theta = (self.theta - other.theta + math.pi) % (2 * math.pi) - math.pi
+        return Pose2D(c * dx + s * dy, -s * dx + c * dy, theta)
     
     def to_vector(self) -> np.ndarray:
         """Convert to vector [x, y, theta]"""
@@ -51,7 +74,7 @@ class Pose2D:
     @staticmethod
     def from_vector(vec: np.ndarray) -> 'Pose2D':
         """Create from vector [x, y, theta]"""
-        return Pose2D(vec[0], vec[1], vec[2])
+        return Pose2D(float(vec[0]), float(vec[1]), float(vec[2]))
 
 @dataclass
 class LidarScan:
@@ -60,9 +83,13 @@ class LidarScan:
     angles: np.ndarray
     max_range: float = 10.0
     
+    def valid_mask(self) -> np.ndarray:
+        """Beams with a return inside (0, max_range)"""
+        return (self.ranges > 0) & (self.ranges < self.max_range) & ~np.isnan(self.ranges)
+    
     def get_points(self, pose: Pose2D) -> np.ndarray:
         """Convert scan to 2D points in world frame"""
-        valid_mask = (self.ranges > 0) & (self.ranges < self.max_range) & ~np.isnan(self.ranges)
+        valid_mask = self.valid_mask()
         valid_ranges = self.ranges[valid_mask]
         valid_angles = self.angles[valid_mask]
         
@@ -71,37 +98,113 @@ class LidarScan:
         local_y = valid_ranges * np.sin(valid_angles)
         
         # Transform to world frame
-        c = np.cos(pose.theta)
-        s = np.sin(pose.theta)
-        
-        world_x = pose.x + c * local_x - s * local_y
-        world_y = pose.y + s * local_x + c * local_y
-        
-        return np.column_stack([world_x, world_y])
+        return se2.transform_points((pose.x, pose.y, pose.theta), np.column_stack([local_x, local_y]))
 
 @dataclass
 class PoseConstraint:
-    """Represents a constraint between two poses"""
+    """Represents a constraint between two poses (one row of a PoseGraph's constraint array)"""
     from_idx: int
     to_idx: int
     transform: Pose2D  # Relative transformation from 'from_idx' to 'to_idx'
     information: np.ndarray  # 3x3 information matrix (inverse covariance)
     constraint_type: str = "odometry"  # "odometry" or "loop_closure"
 
+# Row layout of PoseGraph's constraint storage
+CONSTRAINT_DTYPE = np.dtype([
+    ('from_idx', np.int64),
+    ('to_idx', np.int64),
+    ('dx', np.float64),
+    ('dy', np.float64),
+    ('dtheta', np.float64),
+    ('sqrt_info', np.float64, (3,)),  # sqrt of the information diagonal
+    ('information', np.float64, (3, 3)),
+    ('constraint_type', 'U16'),
+])
+
+class ConstraintList(Sequence):
+    """Read-only list of PoseConstraint views over a constraint array"""
+    
+    def __init__(self, data: np.ndarray):
+        self._data = data
+    
+    def __len__(self) -> int:
+        return len(self._data)
+    
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        row = self._data[index]
+        return PoseConstraint(
+            from_idx=int(row['from_idx']),
+            to_idx=int(row['to_idx']),
+            transform=Pose2D(float(row['dx']), float(row['dy']), float(row['dtheta'])),
+            information=row['information'].copy(),
+            constraint_type=str(row['constraint_type'])
+        )
+
+@dataclass
+class ICPLevel:
+    """One resolution level of coarse-to-fine ICP"""
+    voxel_size: float  # Source downsampling (0 keeps every point)
+    max_correspondence_distance: float
+    max_iterations: int
+    tolerance: float
+
 class ICP:
     """Iterative Closest Point algorithm for scan matching"""
     
+    uses_normals = False  # align() takes source_normals/target_normals
+    
     def __init__(self, max_iterations: int = 50, tolerance: float = 1e-5, 
-                 max_correspondence_distance: float = 0.5):
+                 max_correspondence_distance: float = 0.5,
+                 levels: Optional[List[ICPLevel]] = None):
         self.max_iterations = max_iterations
         self.tolerance = tolerance
         self.max_correspondence_distance = max_correspondence_distance
+        
+        # Coarse-to-fine schedule; None runs a single full-resolution level
+        # with the settings above
+        self.levels = levels
+        
+        # Nearest-neighbour queries (points queried) over all alignments
+        self.num_queries = 0
+        self.num_alignments = 0
+    
+    @staticmethod
+    def coarse_to_fine_levels(max_correspondence_distance: float = 0.3) -> List[ICPLevel]:
+        """Default schedule: wide gate on a sparse cloud, down to the given gate at full resolution"""
+        return [
+            ICPLevel(voxel_size=0.4, max_correspondence_distance=4 * max_correspondence_distance,
+                     max_iterations=15, tolerance=1e-3),
+            ICPLevel(voxel_size=0.2, max_correspondence_distance=2 * max_correspondence_distance,
+                     max_iterations=10, tolerance=1e-3),
+            ICPLevel(voxel_size=0.0, max_correspondence_distance=max_correspondence_distance,
+                     max_iterations=20, tolerance=1e-4),
+        ]
+    
+    def _schedule(self) -> List[ICPLevel]:
+        if self.levels:
+            return self.levels
+        return [ICPLevel(0.0, self.max_correspondence_distance, self.max_iterations, self.tolerance)]
+    
+    @staticmethod
+    def _level_indices(points: np.ndarray, voxel_size: float) -> np.ndarray:
+        """Indices of the points kept at a level (first point per voxel)"""
+        if voxel_size <= 0:
+            return np.arange(len(points))
+        return ScanDownsampler(voxel_size=voxel_size).filter(points, return_indices=True)[1]
     
     def align(self, source_points: np.ndarray, target_points: np.ndarray, 
-              initial_pose: Pose2D = None) -> Tuple[Pose2D, float, bool]:
+              initial_pose: Pose2D = None,
+              target_tree: KDTree = None) -> Tuple[Pose2D, float, bool]:
         """
         Align source points to target points using ICP
         
+        A prebuilt KD-tree of target_points may be passed as target_tree.
+        With levels set, each level refines the previous one's result on a
+        finer source cloud with a tighter gate; the last level decides the
+        fitness and convergence.
+        
         Returns:
             (optimized_pose, fitness_score, converged)
         """
@@ -109,20 +212,37 @@ class ICP:
             initial_pose = Pose2D(0, 0, 0)
         
         current_pose = initial_pose
-        prev_error = float('inf')
         
         # Build KD-tree for target points
-        target_tree = KDTree(target_points)
+        if target_tree is None:
+            target_tree = KDTree(target_points)
         
-        for iteration in range(self.max_iterations):
+        self.num_alignments += 1
+        fitness, converged = 0.0, False
+        for level in self._schedule():
+            source = source_points[self._level_indices(source_points, level.voxel_size)]
+            current_pose, fitness, converged = self._align_level(
+                source, target_points, target_tree, current_pose, level)
+        return current_pose, fitness, converged
+    
+    def _align_level(self, source_points: np.ndarray, target_points: np.ndarray,
+                     target_tree: KDTree, current_pose: Pose2D,
+                     level: ICPLevel) -> Tuple[Pose2D, float, bool]:
+        """ICP iterations of one level, starting from current_pose"""
+        prev_error = float('inf')
+        if len(source_points) == 0:
+            return current_pose, 0.0, False
+        
+        for iteration in range(level.max_iterations):
             # Transform source points
             transformed_source = self._transform_points(source_points, current_pose)
             
             # Find correspondences
             distances, indices = target_tree.query(transformed_source)
+            self.num_queries += len(transformed_source)
             
             # Filter correspondences by distance
-            valid_mask = distances < self.max_correspondence_distance
+            valid_mask = distances < level.max_correspondence_distance
             
             if np.sum(valid_mask) < 3:
                 return current_pose, 0.0, False
@@ -134,7 +254,7 @@ class ICP:
             error = np.mean(distances[valid_mask])
             
             # Check convergence
-            if abs(prev_error - error) < self.tolerance:
+            if abs(prev_error - error) < level.tolerance:
                 fitness = np.sum(valid_mask) / len(source_points)
                 return current_pose, fitness, True
             
@@ -151,13 +271,7 @@ class ICP:
     
     def _transform_points(self, points: np.ndarray, pose: Pose2D) -> np.ndarray:
         """Transform points by pose"""
-        c = np.cos(pose.theta)
-        s = np.sin(pose.theta)
-        
-        rotation = np.array([[c, -s], [s, c]])
-        translation = np.array([pose.x, pose.y])
-        
-        return (rotation @ points.T).T + translation
+        return se2.transform_points((pose.x, pose.y, pose.theta), points)
     
     def _compute_transformation(self, source: np.ndarray, target: np.ndarray) -> Pose2D:
         """Compute transformation from source to target using SVD"""
@@ -189,173 +303,1501 @@ class ICP:
         
         return Pose2D(t[0], t[1], theta)
 
+class PointToLineICP(ICP):
+    """Point-to-line ICP (office_loop.slam_front_end) behind the ICP.align interface"""
+    
+    uses_normals = True
+    
+    def __init__(self, max_iterations: int = 50, tolerance: float = 1e-5,
+                 max_correspondence_distance: float = 0.5,
+                 max_normal_angle: Optional[float] = np.pi / 4,
+                 levels: Optional[List[ICPLevel]] = None):
+        super().__init__(max_iterations, tolerance, max_correspondence_distance, levels)
+        self.max_normal_angle = max_normal_angle  # None disables normal-compatibility rejection
+    
+    def align(self, source_points: np.ndarray, target_points: np.ndarray,
+              initial_pose: Pose2D = None, target_tree: KDTree = None,
+              source_normals: np.ndarray = None,
+              target_normals: np.ndarray = None) -> Tuple[Pose2D, float, bool]:
+        """
+        Align source points to target points by minimizing point-to-line distances
+        
+        Normals are estimated from the points unless passed in.
+        
+        Returns:
+            (optimized_pose, fitness_score, converged)
+        """
+        if initial_pose is None:
+            initial_pose = Pose2D(0, 0, 0)
+        if target_tree is None:
+            target_tree = KDTree(target_points)
+        if target_normals is None:
+            target_normals = estimate_normals(target_points, ordered=True)
+        if source_normals is None and self.max_normal_angle is not None:
+            source_normals = estimate_normals(source_points, ordered=True)
+        
+        self.num_alignments += 1
+        pose = initial_pose.to_vector()
+        fitness, converged = 0.0, False
+        for level in self._schedule():
+            keep = self._level_indices(source_points, level.voxel_size)
+            pose, fitness, converged = point_to_line_icp(
+                source_points[keep], target_points, pose,
+                max_iter=level.max_iterations, tolerance=level.tolerance,
+                max_distance=level.max_correspondence_distance,
+                max_normal_angle=self.max_normal_angle, target_tree=target_tree,
+                source_normals=None if source_normals is None else source_normals[keep],
+                target_normals=target_normals
+            )
+        return Pose2D.from_vector(pose), fitness, converged
+
+class CorrelativeScanMatcher:
+    """
+    Branch-and-bound correlative scan matching on a max-pooled grid pyramid
+    
+    The target points are rasterized into a likelihood grid. Level h of the
+    pyramid holds, per cell, the max of the 2^h x 2^h window starting there,
+    so a coarse score bounds every finer offset below it. The search over an
+    (x, y, theta) window around the initial pose then returns the globally
+    best pose on the search lattice.
+    """
+    
+    def __init__(self, resolution: float = 0.05, linear_window: float = 1.0,
+                 angular_window: float = 0.5, depth: int = 5, min_score: float = 0.55,
+                 max_cached_targets: int = 64):
+        self.resolution = resolution
+        self.linear_window = linear_window  # +/- meters around the initial guess
+        self.angular_window = angular_window  # +/- radians around the initial guess
+        self.depth = depth  # Pyramid levels; the coarsest steps 2^(depth-1) cells
+        self.min_score = min_score
+        self.sigma = resolution  # Width of the likelihood around each target point
+        self.max_cached_targets = max_cached_targets
+        self._pyramids: 'OrderedDict[object, tuple]' = OrderedDict()
+    
+    def __getstate__(self):
+        # Pyramids stay with the process that built them
+        state = self.__dict__.copy()
+        state['_pyramids'] = OrderedDict()
+        return state
+    
+    def _build_pyramid(self, target_points: np.ndarray) -> tuple:
+        """Likelihood grid of the target points and its max-pooled levels"""
+        pad = 2 ** self.depth
+        margin = 3 * self.sigma
+        origin = target_points.min(axis=0) - margin
+        size = np.ceil((target_points.max(axis=0) + margin - origin) / self.resolution).astype(int) + 1
+        
+        # Likelihood from the distance to the nearest target cell
+        hits = np.ones((size[1], size[0]), dtype=bool)
+        cells = np.floor((target_points - origin) / self.resolution).astype(int)
+        hits[cells[:, 1], cells[:, 0]] = False
+        distance = distance_transform_edt(hits) * self.resolution
+        likelihood = np.exp(-0.5 * (distance / self.sigma) ** 2).astype(np.float32)
+        
+        # Zero border, wider than the coarsest window, so windows hanging off
+        # the grid are bounded correctly and clipped lookups read zero
+        level = np.zeros((size[1] + 2 * pad, size[0] + 2 * pad), dtype=np.float32)
+        level[pad:pad + size[1], pad:pad + size[0]] = likelihood
+        levels = [level]
+        for h in range(1, self.depth):
+            step = 2 ** (h - 1)
+            prev = levels[-1]
+            level = prev.copy()
+            level[:, :-step] = np.maximum(level[:, :-step], prev[:, step:])
+            level[:-step, :] = np.maximum(level[:-step, :], level[step:, :])
+            levels.append(level)
+        return origin, pad, levels
+    
+    def _get_pyramid(self, target_points: np.ndarray, target_key) -> tuple:
+        if target_key is None:
+            return self._build_pyramid(target_points)
+        if target_key in self._pyramids:
+            self._pyramids.move_to_end(target_key)
+            return self._pyramids[target_key]
+        pyramid = self._build_pyramid(target_points)
+        self._pyramids[target_key] = pyramid
+        if len(self._pyramids) > self.max_cached_targets:
+            self._pyramids.popitem(last=False)
+        return pyramid
+    
+    def match(self, source_points: np.ndarray, target_points: np.ndarray,
+              initial_pose: Pose2D = None, target_key=None) -> Tuple[Pose2D, float, bool]:
+        """
+        Find the pose of the source scan in the target frame
+        
+        target_key (e.g. a pose index) lets the target's pyramid be reused.
+        
+        Returns:
+            (best_pose, score, success) where score is the mean likelihood in [0, 1]
+        """
+        if initial_pose is None:
+            initial_pose = Pose2D(0, 0, 0)
+        if len(source_points) == 0 or len(target_points) == 0:
+            return initial_pose, 0.0, False
+        
+        origin, pad, levels = self._get_pyramid(target_points, target_key)
+        window = int(np.ceil(self.linear_window / self.resolution))
+        
+        # Angular step keeps the farthest point within about one cell
+        max_range = np.max(np.hypot(source_points[:, 0], source_points[:, 1]))
+        angle_step = np.arccos(1 - self.resolution ** 2 / (2 * max(max_range, self.resolution) ** 2))
+        num_angles = int(np.ceil(self.angular_window / angle_step))
+        angles = initial_pose.theta + angle_step * np.arange(-num_angles, num_angles + 1)
+        
+        # Base cell of every source point for every candidate angle, shape (K, P)
+        c = np.cos(angles)[:, None]
+        s = np.sin(angles)[:, None]
+        px = initial_pose.x + c * source_points[:, 0] - s * source_points[:, 1]
+        py = initial_pose.y + s * source_points[:, 0] + c * source_points[:, 1]
+        base_x = np.floor((px - origin[0]) / self.resolution).astype(np.int64) + pad
+        base_y = np.floor((py - origin[1]) / self.resolution).astype(np.int64) + pad
+        num_points = source_points.shape[0]
+        
+        def score(h: int, k: np.ndarray, ox: np.ndarray, oy: np.ndarray) -> np.ndarray:
+            """Mean level-h value of the points of candidates (k, ox, oy)"""
+            grid = levels[h]
+            # Off-grid lookups are clipped onto the zero border
+            xs = np.clip(base_x[k] + ox[:, None], 0, grid.shape[1] - 1)
+            ys = np.clip(base_y[k] + oy[:, None], 0, grid.shape[0] - 1)
+            return grid[ys, xs].sum(axis=1) / num_points
+        
+        # Coarsest level covers the window with steps of 2^(depth-1) cells
+        top = self.depth - 1
+        offsets = np.arange(-window, window + 1, 2 ** top)
+        k, ox, oy = (a.ravel() for a in np.meshgrid(np.arange(len(angles)), offsets, offsets,
+                                                    indexing='ij'))
+        top_scores = score(top, k, ox, oy)
+        order = np.argsort(top_scores)
+        stack = [(top, top_scores[i], k[i], ox[i], oy[i]) for i in order]
+        
+        best_score = self.min_score
+        best = None
+        while stack:
+            h, bound, ck, cx, cy = stack.pop()
+            if bound <= best_score:
+                continue
+            if h == 0:
+                best_score, best = bound, (ck, cx, cy)
+                continue
+            
+            # Branch into the four half-size windows that fit in the search window
+            step = 2 ** (h - 1)
+            child_x = np.array([cx, cx + step, cx, cx + step])
+            child_y = np.array([cy, cy, cy + step, cy + step])
+            keep = (child_x <= window) & (child_y <= window)
+            child_x, child_y = child_x[keep], child_y[keep]
+            child_scores = score(h - 1, np.full(len(child_x), ck), child_x, child_y)
+            for i in np.argsort(child_scores):
+                if child_scores[i] > best_score:
+                    stack.append((h - 1, child_scores[i], ck, child_x[i], child_y[i]))
+        
+        if best is None:
+            return initial_pose, 0.0, False
+        
+        ck, cx, cy = best
+        best_pose = Pose2D(initial_pose.x + cx * self.resolution,
+                           initial_pose.y + cy * self.resolution,
+                           angles[ck])
+        return best_pose, float(best_score), True
+
+class PoseSpatialIndex:
+    """Grid hash over pose positions for sublinear radius queries"""
+    
+    def __init__(self, cell_size: float = 2.0):
+        self.cell_size = cell_size
+        self.cells: Dict[Tuple[int, int], List[int]] = defaultdict(list)
+        self.positions = np.zeros((64, 2))
+        self.size = 0
+        
+        # Lookup statistics
+        self.num_queries = 0
+        self.total_candidates = 0
+        self.total_lookup_time = 0.0
+        self.last_candidates = 0
+        self.last_lookup_time = 0.0
+    
+    def _cell(self, x: float, y: float) -> Tuple[int, int]:
+        return int(np.floor(x / self.cell_size)), int(np.floor(y / self.cell_size))
+    
+    def insert(self, x: float, y: float) -> int:
+        """Add a position, returns its index"""
+        if self.size == len(self.positions):
+            self.positions = np.vstack([self.positions, np.zeros_like(self.positions)])
+        idx = self.size
+        self.positions[idx] = (x, y)
+        self.cells[self._cell(x, y)].append(idx)
+        self.size += 1
+        return idx
+    
+    def update(self, idx: int, x: float, y: float):
+        """Move an indexed position, e.g. after a partial optimization"""
+        old_cell = self._cell(*self.positions[idx])
+        new_cell = self._cell(x, y)
+        self.positions[idx] = (x, y)
+        if old_cell != new_cell:
+            self.cells[old_cell].remove(idx)
+            if not self.cells[old_cell]:
+                del self.cells[old_cell]
+            self.cells[new_cell].append(idx)
+    
+    def rebuild(self, poses: List[Pose2D]):
+        """Re-index all positions, e.g. after the poses have been optimized"""
+        self.cells = defaultdict(list)
+        self.size = 0
+        for pose in poses:
+            self.insert(pose.x, pose.y)
+    
+    def query(self, x: float, y: float, radius: float, max_index: int = None) -> np.ndarray:
+        """
+        Indices (ascending) of positions closer than radius to (x, y)
+        
+        Only indices below max_index are returned, if given.
+        """
+        start_time = time.perf_counter()
+        
+        cx, cy = self._cell(x, y)
+        ring = int(np.ceil(radius / self.cell_size))
+        buckets = [self.cells[key]
+                   for key in ((cx + i, cy + j)
+                               for i in range(-ring, ring + 1)
+                               for j in range(-ring, ring + 1))
+                   if key in self.cells]
+        candidates = np.array([idx for bucket in buckets for idx in bucket], dtype=int)
+        if max_index is not None:
+            candidates = candidates[candidates < max_index]
+        
+        # Exact distance test on the few positions from nearby cells
+        offsets = self.positions[candidates] - (x, y)
+        candidates = np.sort(candidates[np.hypot(offsets[:, 0], offsets[:, 1]) < radius])
+        
+        elapsed = time.perf_counter() - start_time
+        self.num_queries += 1
+        self.total_candidates += len(candidates)
+        self.total_lookup_time += elapsed
+        self.last_candidates = len(candidates)
+        self.last_lookup_time = elapsed
+        return candidates
+
+class ScanCache:
+    """LRU cache of local-frame scan points, their KD-trees and normals, keyed by pose index"""
+    
+    def __init__(self, max_bytes: int = 128 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.entries: 'OrderedDict[int, list]' = OrderedDict()  # idx -> [points, tree, normals]
+        self.num_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        
+        # Called with the index of every evicted scan
+        self.on_evict: Optional[Callable[[int], None]] = None
+    
+    @staticmethod
+    def _entry_bytes(points: np.ndarray) -> int:
+        # Points plus a KD-tree, which holds a copy of the data and an index
+        # array, plus normals
+        return 4 * points.nbytes
+    
+    def put(self, idx: int, points: np.ndarray) -> list:
+        """Cache the local points of scan idx (KD-tree and normals are built on first use)"""
+        if idx in self.entries:
+            self.num_bytes -= self._entry_bytes(self.entries.pop(idx)[0])
+        entry = [points, None, None]
+        self.entries[idx] = entry
+        self.num_bytes += self._entry_bytes(points)
+        
+        # Evict least recently used entries, but always keep the newest one
+        while self.num_bytes > self.max_bytes and len(self.entries) > 1:
+            old_idx, (old_points, _, _) = self.entries.popitem(last=False)
+            self.num_bytes -= self._entry_bytes(old_points)
+            self.evictions += 1
+            if self.on_evict is not None:
+                self.on_evict(old_idx)
+        return entry
+    
+    def get(self, idx: int) -> Optional[list]:
+        entry = self.entries.get(idx)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(idx)
+        return entry
+
 class PoseGraph:
     """Pose graph for SLAM with optimization"""
     
-    def __init__(self):
+    def __init__(self, index_cell_size: float = 2.0,
+                 scan_cache_bytes: int = 128 * 1024 * 1024):
         self.poses: List[Pose2D] = []
-        self.constraints: List[PoseConstraint] = []
         self.scans: List[LidarScan] = []
         
-    def add_pose(self, pose: Pose2D, scan: LidarScan = None):
-        """Add a new pose to the graph"""
+        # Spatial index over pose positions, kept in sync with self.poses
+        self.spatial_index = PoseSpatialIndex(index_cell_size)
+        
+        # Local-frame points and KD-trees of the scans, for reuse as ICP targets
+        self.scan_cache = ScanCache(scan_cache_bytes)
+        
+        # Constraints live in a growable structured array (see CONSTRAINT_DTYPE)
+        self._constraint_data = np.zeros(64, dtype=CONSTRAINT_DTYPE)
+        self._num_constraints = 0
+        
+        # Constraint rows touching each pose, so local solves never scan the whole graph
+        self._pose_constraints: List[List[int]] = []
+        
+        # Pose parameters [x, y, theta] per row, kept in sync with self.poses
+        self._params = np.zeros((64, 3))
+        
+        # Poses written by the last optimization
+        self.last_updated = np.zeros(0, dtype=int)
+        
+        # Levenberg-Marquardt settings
+        self.initial_damping = 1e-4
+        self.function_tolerance = 1e-8  # Relative cost reduction
+        self.step_tolerance = 1e-8  # Relative step size
+        self.gradient_tolerance = 1e-8
+        
+        # Graph size at the last optimization, anything beyond is new
+        self.optimized_poses = 0
+        self.optimized_constraints = 0
+        
+        # Incremental mode: poses whose gradient exceeds this join the solve
+        self.relinearize_threshold = 1e-3
+        self.max_relinearize_rounds = 5
+        
+    def add_pose(self, pose: Pose2D, scan: LidarScan = None,
+                 local_points: np.ndarray = None):
+        """
+        Add a new pose to the graph
+        
+        local_points may pass in scan.get_points(Pose2D(0, 0, 0)) if the
+        caller has already computed it.
+        """
+        if len(self.poses) == len(self._params):
+            grown = np.zeros((2 * len(self._params), 3))
+            grown[:len(self.poses)] = self._params[:len(self.poses)]
+            self._params = grown
+        self._params[len(self.poses)] = pose.to_vector()
+        self._pose_constraints.append([])
         self.poses.append(pose)
+        self.spatial_index.insert(pose.x, pose.y)
         if scan is not None:
             self.scans.append(scan)
+            if local_points is None:
+                local_points = scan.get_points(Pose2D(0, 0, 0))
+            self.scan_cache.put(len(self.poses) - 1, local_points)
+    
+    def _scan_cache_entry(self, idx: int) -> list:
+        entry = self.scan_cache.get(idx)
+        if entry is None:
+            # Evicted earlier, convert the stored scan again
+            entry = self.scan_cache.put(idx, self.scans[idx].get_points(Pose2D(0, 0, 0)))
+        return entry
+    
+    def get_scan_points(self, idx: int) -> np.ndarray:
+        """Local-frame points of scan idx (cached)"""
+        return self._scan_cache_entry(idx)[0]
+    
+    def get_scan_normals(self, idx: int) -> np.ndarray:
+        """Normals of the local-frame points of scan idx (cached)"""
+        entry = self._scan_cache_entry(idx)
+        if entry[2] is None:
+            # Points come out of get_points in beam order
+            entry[2] = estimate_normals(entry[0], ordered=True)
+        return entry[2]
+    
+    def get_scan_tree(self, idx: int) -> KDTree:
+        """KD-tree over the local-frame points of scan idx (cached)"""
+        entry = self._scan_cache_entry(idx)
+        if entry[1] is None:
+            entry[1] = KDTree(entry[0])
+        return entry[1]
     
     def add_constraint(self, constraint: PoseConstraint):
         """Add a constraint between poses"""
-        self.constraints.append(constraint)
+        if self._num_constraints == len(self._constraint_data):
+            grown = np.zeros(2 * len(self._constraint_data), dtype=CONSTRAINT_DTYPE)
+            grown[:self._num_constraints] = self._constraint_data
+            self._constraint_data = grown
+        
+        row = self._constraint_data[self._num_constraints]
+        row['from_idx'] = constraint.from_idx
+        row['to_idx'] = constraint.to_idx
+        row['dx'] = constraint.transform.x
+        row['dy'] = constraint.transform.y
+        row['dtheta'] = constraint.transform.theta
+        row['sqrt_info'] = np.sqrt(np.diagonal(constraint.information))
+        row['information'] = constraint.information
+        row['constraint_type'] = constraint.constraint_type
+        for idx in {constraint.from_idx, constraint.to_idx}:
+            while len(self._pose_constraints) <= idx:
+                self._pose_constraints.append([])
+            self._pose_constraints[idx].append(self._num_constraints)
+        self._num_constraints += 1
+    
+    @property
+    def constraint_array(self) -> np.ndarray:
+        """Structured array of all constraints (a view, not a copy)"""
+        return self._constraint_data[:self._num_constraints]
+    
+    @property
+    def constraints(self) -> ConstraintList:
+        """All constraints as PoseConstraint views"""
+        return ConstraintList(self.constraint_array)
+    
+    def _rows_touching(self, indices: np.ndarray) -> np.ndarray:
+        """Sorted constraint rows with an endpoint in indices"""
+        rows = [self._pose_constraints[i] for i in indices.tolist() if i < len(self._pose_constraints)]
+        return np.unique(np.fromiter(itertools.chain.from_iterable(rows), dtype=int))
+    
+    def _local_problem(self, rows: np.ndarray, free_indices: np.ndarray):
+        """
+        Subproblem over the given constraint rows with free_indices as variables
+        
+        Returns the rows with endpoints renumbered into the involved poses,
+        the parameters of those poses, the Jacobian column of each involved
+        pose (-1 if fixed) and the local index of each free pose.
+        """
+        data = self.constraint_array[rows]
+        involved = np.union1d(np.union1d(data['from_idx'], data['to_idx']), free_indices)
+        data['from_idx'] = np.searchsorted(involved, data['from_idx'])
+        data['to_idx'] = np.searchsorted(involved, data['to_idx'])
+        local = np.searchsorted(involved, free_indices)
+        columns = np.full(len(involved), -1)
+        columns[local] = np.arange(len(free_indices))
+        return data, self._params[involved].ravel(), columns, local
     
-    def optimize(self, max_iterations: int = 100) -> bool:
-        """Optimize the pose graph using least squares"""
-        if len(self.poses) < 2:
+    def optimize(self, max_iterations: int = 100, free_indices: np.ndarray = None) -> bool:
+        """
+        Optimize the pose graph with sparse Levenberg-Marquardt
+        
+        The first pose is held fixed (gauge), so only poses 1..N-1 are
+        variables. Each iteration assembles the analytic SE(2) Jacobian
+        and solves the sparse normal equations. With free_indices only the
+        constraints touching those poses and the poses they reach are
+        assembled, so a window solve does not grow with the graph.
+        
+        Args:
+            max_iterations: Maximum LM iterations
+            free_indices: Poses to optimize, all others are held fixed (default: all but the first)
+        """
+        self.last_updated = np.zeros(0, dtype=int)
+        num_poses = len(self.poses)
+        if num_poses < 2:
             return False
         
-        # Convert poses to parameter vector
-        x0 = np.zeros(len(self.poses) * 3)
-        for i, pose in enumerate(self.poses):
-            x0[i*3:(i+1)*3] = pose.to_vector()
+        full = free_indices is None
+        if full:
+            free_indices = np.arange(1, num_poses)
+        else:
+            free_indices = np.unique(np.asarray(free_indices, dtype=int))
+            free_indices = free_indices[free_indices > 0]
+            if len(free_indices) == 0:
+                return False
+        
+        if full:
+            data = self.constraint_array
+            params = self._params[:num_poses].ravel().copy()
+            columns = np.arange(num_poses) - 1
+            local = free_indices
+        else:
+            # Only constraints touching a free pose change the cost, and only
+            # the poses they reach enter the solve
+            data, params, columns, local = self._local_problem(self._rows_touching(free_indices),
+                                                               free_indices)
         
-        # Fix the first pose (anchor)
-        fixed_indices = [0, 1, 2]  # x, y, theta of first pose
+        residuals = self._residuals(params, data)
+        cost = residuals @ residuals
+        damping = self.initial_damping
+        relinearize = True
+        success = False
         
-        # Optimize
-        result = least_squares(
-            self._residuals,
-            x0,
-            max_nfev=max_iterations,
-            verbose=0
-        )
+        for iteration in range(max_iterations):
+            if relinearize:
+                jacobian = self._jacobian(params, data, columns)
+                gradient = jacobian.T @ residuals
+                if np.max(np.abs(gradient), initial=0.0) < self.gradient_tolerance:
+                    success = True
+                    break
+                hessian = (jacobian.T @ jacobian).tocsc()
+                hessian_diag = np.maximum(hessian.diagonal(), 1e-12)
+            
+            # Damped normal equations: (H + lambda * diag(H)) step = -g
+            step = spsolve((hessian + diags(damping * hessian_diag)).tocsc(), -gradient)
+            candidate = params.copy()
+            candidate.reshape(-1, 3)[local] += step.reshape(-1, 3)
+            candidate_residuals = self._residuals(candidate, data)
+            candidate_cost = candidate_residuals @ candidate_residuals
+            
+            if candidate_cost < cost:
+                reduction = cost - candidate_cost
+                params, residuals, cost = candidate, candidate_residuals, candidate_cost
+                damping = max(damping / 10, 1e-12)
+                relinearize = True
+                if (reduction <= self.function_tolerance * cost or
+                        np.linalg.norm(step) <= self.step_tolerance * (self.step_tolerance + np.linalg.norm(params))):
+                    success = True
+                    break
+            else:
+                # Rejected step, retry with more damping on the same linearization
+                damping *= 10
+                relinearize = False
         
         # Update poses with optimized values
-        optimized_params = result.x
-        for i in range(len(self.poses)):
-            self.poses[i] = Pose2D.from_vector(optimized_params[i*3:(i+1)*3])
+        self._params[free_indices] = params.reshape(-1, 3)[local]
+        for i in free_indices.tolist():
+            self.poses[i] = Pose2D.from_vector(self._params[i])
+            if not full:
+                self.spatial_index.update(i, self.poses[i].x, self.poses[i].y)
+        if full:
+            self.spatial_index.rebuild(self.poses)
+            self.optimized_poses = num_poses
+            self.optimized_constraints = self._num_constraints
+        self.last_updated = free_indices
         
-        return result.success
+        return success
     
-    def _residuals(self, params: np.ndarray) -> np.ndarray:
-        """Compute residuals for all constraints"""
-        residuals = []
+    def optimize_window(self, window_size: int, max_iterations: int = 100) -> bool:
+        """
+        Optimize only the last window_size poses
         
-        for constraint in self.constraints:
-            # Extract poses
-            i = constraint.from_idx
-            j = constraint.to_idx
-            
-            pose_i = Pose2D.from_vector(params[i*3:(i+1)*3])
-            pose_j = Pose2D.from_vector(params[j*3:(j+1)*3])
-            
-            # Compute predicted relative transformation
-            predicted_transform = pose_i.inverse().compose(pose_j)
-            
-            # Compute error
-            error = self._pose_difference(predicted_transform, constraint.transform)
-            
-            # Weight by information matrix
-            weighted_error = np.sqrt(constraint.information.diagonal()) * error
+        Older poses are held fixed and act as a prior through the
+        constraints that link them to the window.
+        """
+        start = max(len(self.poses) - window_size, 1)
+        success = self.optimize(max_iterations, np.arange(start, len(self.poses)))
+        self.optimized_poses = len(self.poses)
+        self.optimized_constraints = self._num_constraints
+        return success
+    
+    def optimize_incremental(self, max_iterations: int = 100) -> bool:
+        """
+        Optimize only the poses affected by what was added since the last solve
+        
+        Starts from the new poses and the endpoints of new constraints,
+        then grows the set with neighbouring poses whose gradient exceeds
+        relinearize_threshold after the solve, like iSAM's fluid
+        relinearization. Well-constrained graphs settle after a few poses.
+        """
+        new = self.constraint_array[self.optimized_constraints:]
+        free = np.union1d(np.arange(self.optimized_poses, len(self.poses)),
+                          np.concatenate([new['from_idx'], new['to_idx']]))
+        
+        success = False
+        updated = np.zeros(0, dtype=int)
+        for _ in range(self.max_relinearize_rounds):
+            success = self.optimize(max_iterations, free)
+            updated = np.union1d(updated, self.last_updated)
             
-            residuals.extend(weighted_error)
+            # Gradient on the poses next to the solved set
+            rows = self._rows_touching(free)
+            touching = self.constraint_array[rows]
+            neighbours = np.setdiff1d(np.concatenate([touching['from_idx'], touching['to_idx']]), free)
+            neighbours = neighbours[neighbours > 0]
+            if len(neighbours) == 0:
+                break
+            data, params, columns, _ = self._local_problem(rows, neighbours)
+            gradient = self._jacobian(params, data, columns).T @ self._residuals(params, data)
+            stale = neighbours[np.max(np.abs(gradient.reshape(-1, 3)), axis=1) > self.relinearize_threshold]
+            if len(stale) == 0:
+                break
+            free = np.union1d(free, stale)
         
-        # Add anchor constraint for first pose
-        anchor_error = params[0:3] - self.poses[0].to_vector()
-        residuals.extend(anchor_error * 1000)  # Strong weight
+        self.last_updated = updated
+        self.optimized_poses = len(self.poses)
+        self.optimized_constraints = self._num_constraints
+        return success
+    
+    def _residuals(self, params: np.ndarray, data: np.ndarray = None) -> np.ndarray:
+        """Compute residuals for all constraints (or the given rows) in one vectorized pass"""
+        if data is None:
+            data = self.constraint_array
+        poses = params.reshape(-1, 3)
+        pose_i = poses[data['from_idx']]
+        pose_j = poses[data['to_idx']]
+        
+        # Predicted relative transformation inv(pose_i) * pose_j
+        predicted = se2.relative(pose_i, pose_j)
         
-        return np.array(residuals)
+        # Error against the measured transform
+        errors = np.column_stack([
+            predicted[:, 0] - data['dx'],
+            predicted[:, 1] - data['dy'],
+            self._normalize_angle(predicted[:, 2] - data['dtheta'])
+        ])
+        
+        # Weight by information matrix
+        return (errors * data['sqrt_info']).ravel()
     
-    def _pose_difference(self, pose1: Pose2D, pose2: Pose2D) -> np.ndarray:
-        """Compute difference between two poses"""
-        dx = pose1.x - pose2.x
-        dy = pose1.y - pose2.y
-        dtheta = self._normalize_angle(pose1.theta - pose2.theta)
-        return np.array([dx, dy, dtheta])
+    def _jacobian(self, params: np.ndarray, data: np.ndarray = None,
+                  columns: np.ndarray = None) -> csr_matrix:
+        """
+        Analytic sparse Jacobian of the residuals w.r.t. the free poses
+        
+        Each constraint touches only its two poses, giving two 3x3 blocks.
+        columns maps each pose to its column block (-1 for fixed poses);
+        by default poses 1..N-1 are free and the first pose is dropped.
+        """
+        if data is None:
+            data = self.constraint_array
+        if columns is None:
+            columns = np.arange(len(params) // 3) - 1
+        from_idx = data['from_idx']
+        to_idx = data['to_idx']
+        sqrt_info = data['sqrt_info']
+        num_constraints = len(data)
+        num_vars = 3 * (columns.max() + 1)
+        poses = params.reshape(-1, 3)
+        pose_i = poses[from_idx]
+        pose_j = poses[to_idx]
+        
+        c = np.cos(pose_i[:, 2])
+        s = np.sin(pose_i[:, 2])
+        dx = pose_j[:, 0] - pose_i[:, 0]
+        dy = pose_j[:, 1] - pose_i[:, 1]
+        zeros = np.zeros(num_constraints)
+        ones = np.ones(num_constraints)
+        
+        # Predicted relative pose is (R_i^T (t_j - t_i), theta_j - theta_i)
+        block_i = np.array([
+            [-c, -s, -s * dx + c * dy],
+            [s, -c, -c * dx - s * dy],
+            [zeros, zeros, -ones]
+        ]).transpose(2, 0, 1)
+        block_j = np.array([
+            [c, s, zeros],
+            [-s, c, zeros],
+            [zeros, zeros, ones]
+        ]).transpose(2, 0, 1)
+        
+        # Weight rows by the square root of the information diagonal
+        block_i = block_i * sqrt_info[:, :, None]
+        block_j = block_j * sqrt_info[:, :, None]
+        
+        rows = np.broadcast_to(3 * np.arange(num_constraints)[:, None, None] +
+                               np.arange(3)[None, :, None], block_i.shape)
+        values, row_idx, col_idx = [], [], []
+        for block, idx in ((block_i, from_idx), (block_j, to_idx)):
+            cols = np.broadcast_to(3 * columns[idx][:, None, None] +
+                                   np.arange(3)[None, None, :], block.shape)
+            free = np.broadcast_to((columns[idx] >= 0)[:, None, None], block.shape)
+            values.append(block[free])
+            row_idx.append(rows[free])
+            col_idx.append(cols[free])
+        
+        return coo_matrix((np.concatenate(values), (np.concatenate(row_idx), np.concatenate(col_idx))),
+                          shape=(3 * num_constraints, num_vars)).tocsr()
     
-    def _normalize_angle(self, angle: float) -> float:
-        """Normalize angle to [-pi, pi]"""
-        while angle > np.pi:
-            angle -= 2 * np.pi
-        while angle < -np.pi:
-            angle += 2 * np.pi
-        return angle
+    def _normalize_angle(self, angle):
+        """Normalize angle(s) to [-pi, pi)"""
+        return se2.normalize_angle(angle)
+
+@dataclass
+class ScanContribution:
+    """Rays a scan added to the map, and the pose it was rasterized at"""
+    pose: Pose2D
+    origin_mx: np.ndarray  # Per-ray start cell
+    origin_my: np.ndarray
+    end_mx: np.ndarray  # Per-ray hit cell
+    end_my: np.ndarray
 
 class OccupancyGridMap:
     """2D Occupancy Grid Map"""
     
-    def __init__(self, width: int, height: int, resolution: float, origin: Tuple[float, float]):
+    def __init__(self, width: int, height: int, resolution: float, origin: Tuple[float, float],
+                 tile_size: int = 64, log_odds_dtype=np.float64):
+        # width x height cells from origin is the default window of dense
+        # exports; cells outside it are still stored
         self.width = width
         self.height = height
         self.resolution = resolution
         self.origin = np.array(origin)
-        self.log_odds = np.zeros((height, width))
         self.l_occ = np.log(0.7 / 0.3)
         self.l_free = np.log(0.3 / 0.7)
         self.l_min = -5.0
         self.l_max = 5.0
+        
+        # Net hit count per cell (occupied minus free hits; l_free == -l_occ,
+        # so log-odds are net * l_occ), in tiles allocated on first touch
+        # ([my, mx] coordinates). Log-odds are derived from it when read, so
+        # a scan's contribution can be subtracted again exactly.
+        #
+        # Compact storage: with an integer log_odds_dtype (np.int16 or np.int8)
+        # the count is kept in that dtype and saturates at +/- net_limit, the
+        # first count whose log-odds reach l_max, and log-odds are exported in
+        # fixed point. Cells take 2 (int16) or 1 (int8) bytes instead of 4
+        # (int32). Removing a scan is approximate once a cell has saturated.
+        self.log_odds_codec = FixedPoint(log_odds_dtype, self.l_max)
+        if self.log_odds_codec.quantized:
+            self.net_limit = int(np.ceil(self.l_max / self.l_occ))
+            count_dtype = self.log_odds_codec.dtype
+        else:
+            self.net_limit = None
+            count_dtype = np.int32
+        self.tiles = TiledGrid(tile_size, {'net': (count_dtype, 0)})
+        # Occupancy percentages, recomputed only for tiles changed since the last export
+        self.occupancy_view = CachedView(self.tiles, 'net', self._occupancy_from_counts, np.int8)
     
     def world_to_map(self, x: float, y: float) -> Tuple[int, int]:
-        mx = int((x - self.origin[0]) / self.resolution)
-        my = int((y - self.origin[1]) / self.resolution)
+        mx = int(np.floor((x - self.origin[0]) / self.resolution))
+        my = int(np.floor((y - self.origin[1]) / self.resolution))
         return mx, my
     
     def is_valid(self, mx: int, my: int) -> bool:
+        """True if the cell lies in the default export window"""
         return 0 <= mx < self.width and 0 <= my < self.height
     
+    def clear(self):
+        """Reset every cell to unknown (and free all tiles)"""
+        self.tiles.clear()
+    
     def update_cell(self, mx: int, my: int, occupied: bool):
-        if not self.is_valid(mx, my):
-            return
-        if occupied:
-            self.log_odds[my, mx] += self.l_occ
+        self.update_cells(np.array([mx]), np.array([my]), np.array([occupied]))
+    
+    def update_cells(self, mx: np.ndarray, my: np.ndarray, occupied: np.ndarray, weight: int = 1):
+        """
+        Apply a batch of free/occupied cell updates
+        
+        weight=-1 removes updates that were applied earlier.
+        """
+        self.add_net(mx, my, np.where(occupied, 1, -1), weight)
+    
+    def add_counts(self, mx: np.ndarray, my: np.ndarray, occ: np.ndarray, free: np.ndarray,
+                   weight: int = 1):
+        """Add per-cell hit counts at cells (mx, my) (weight=-1 removes them)"""
+        self.add_net(mx, my, np.asarray(occ, dtype=np.int64) - free, weight)
+    
+    def add_net(self, mx: np.ndarray, my: np.ndarray, net: np.ndarray, weight: int = 1):
+        """Add net hit counts (occupied minus free) at cells (mx, my) (weight=-1 removes them)"""
+        net = weight * np.asarray(net, dtype=np.int64)
+        address = self.tiles.address(my, mx)
+        if self.net_limit is None:
+            self.tiles.add('net', address, net)
         else:
-            self.log_odds[my, mx] += self.l_free
-        self.log_odds[my, mx] = np.clip(self.log_odds[my, mx], self.l_min, self.l_max)
+            self.tiles.add('net', address, net, saturate=True, limits=(-self.net_limit, self.net_limit))
+        self.tiles.touch(address)
+    
+    def _log_odds_from_counts(self, net: np.ndarray) -> np.ndarray:
+        """Clipped log-odds of net hit counts, as encoded by log_odds_codec"""
+        return self.log_odds_codec.encode(np.clip(net * self.l_occ, self.l_min, self.l_max))
+    
+    def stored_log_odds(self, my0: int, mx0: int, shape: Tuple[int, int]) -> np.ndarray:
+        """Encoded log-odds of cells [my0, my0 + shape[0]) x [mx0, mx0 + shape[1])"""
+        return self._log_odds_from_counts(self.tiles.to_dense('net', my0, mx0, shape))
+    
+    def get_window(self, explored: bool = False) -> Tuple[int, int, int, int]:
+        """
+        Cell window (mx0, my0, width, height) of a dense export
+        
+        The default window, or its union with all allocated tiles if explored.
+        """
+        mx0, my0, mx1, my1 = 0, 0, self.width, self.height
+        if explored and self.tiles.num_tiles:
+            tile_my0, tile_mx0, tile_my1, tile_mx1 = self.tiles.bounds()
+            mx0, my0 = min(mx0, tile_mx0), min(my0, tile_my0)
+            mx1, my1 = max(mx1, tile_mx1), max(my1, tile_my1)
+        return mx0, my0, mx1 - mx0, my1 - my0
+    
+    def get_extent(self, explored: bool = False) -> List[float]:
+        """World extent [x0, x1, y0, y1] of a dense export, as for imshow"""
+        mx0, my0, width, height = self.get_window(explored)
+        x0 = self.origin[0] + mx0 * self.resolution
+        y0 = self.origin[1] + my0 * self.resolution
+        return [x0, x0 + width * self.resolution, y0, y0 + height * self.resolution]
+    
+    def to_dense(self, layer: str = 'log_odds', explored: bool = False) -> np.ndarray:
+        """Dense [my, mx] copy of 'net' (hit counts) or 'log_odds' (decoded to float64)"""
+        mx0, my0, width, height = self.get_window(explored)
+        if layer == 'log_odds':
+            return self.log_odds_codec.decode(self.stored_log_odds(my0, mx0, (height, width)))
+        return self.tiles.to_dense(layer, my0, mx0, (height, width))
     
-    def get_occupancy_grid(self) -> np.ndarray:
-        odds = np.exp(self.log_odds)
+    @property
+    def log_odds(self) -> np.ndarray:
+        """Dense log-odds of the default window"""
+        return self.to_dense('log_odds')
+    
+    def _occupancy_from_counts(self, net: np.ndarray) -> np.ndarray:
+        odds = np.exp(self.log_odds_codec.decode(self._log_odds_from_counts(net)))
         prob = odds / (1 + odds)
         return (prob * 100).astype(np.int8)
+    
+    def get_occupancy_grid(self, explored: bool = False) -> np.ndarray:
+        """
+        Dense [my, mx] occupancy in percent
+        
+        A read-only view of a cache that later map updates change in place;
+        copy it to keep a snapshot.
+        """
+        mx0, my0, width, height = self.get_window(explored)
+        return self.occupancy_view.to_dense(my0, mx0, (height, width))
+
+class LikelihoodField:
+    """
+    Distance-to-nearest-obstacle field of an OccupancyGridMap, for scan-to-map scoring
+    
+    Distances (capped at max_distance) are kept per map tile and recomputed
+    lazily, with a Euclidean distance transform, only around tiles that
+    changed since the last update. A point at distance d scores
+    exp(-d^2 / (2 sigma^2)).
+    """
+    
+    def __init__(self, grid: OccupancyGridMap, max_distance: float = 0.5, sigma: float = 0.1,
+                 occupied_log_odds: float = 0.0):
+        self.grid = grid
+        self.max_distance = max_distance
+        self.sigma = sigma
+        self.occupied_log_odds = occupied_log_odds  # Cells above this count as obstacles
+        self.margin = int(np.ceil(max_distance / grid.resolution))
+        if self.margin > grid.tiles.tile_size:
+            raise ValueError("max_distance must not exceed one map tile")
+        
+        self.field = TiledGrid(grid.tiles.tile_size, {'distance': (np.float32, max_distance)})
+        self._seen_versions = np.zeros(0, dtype=np.int64)  # Map tile versions already applied
+        self._seen_generation = -1
+        self.tiles_updated = 0
+    
+    def update(self):
+        """Recompute distances around map tiles that changed since the last call"""
+        tiles = self.grid.tiles
+        versions = tiles.versions[:tiles.num_tiles]
+        if self._seen_generation != tiles.generation:
+            # Map was cleared, start over
+            self.field.clear()
+            self._seen_versions = np.zeros(0, dtype=np.int64)
+            self._seen_generation = tiles.generation
+        
+        seen = np.zeros(len(versions), dtype=np.int64)
+        seen[:len(self._seen_versions)] = self._seen_versions[:len(versions)]
+        changed = np.flatnonzero(versions != seen)
+        if len(changed) == 0:
+            return
+        
+        # Distances reach one margin into the neighbouring tiles
+        dirty = set()
+        for tile_my, tile_mx in tiles.tile_coords[changed].tolist():
+            dirty.update((tile_my + i, tile_mx + j) for i in (-1, 0, 1) for j in (-1, 0, 1))
+        for tile in dirty:
+            self._update_tile(*tile)
+        
+        self._seen_versions = versions.copy()
+        self.tiles_updated += len(dirty)
+    
+    def _update_tile(self, tile_my: int, tile_mx: int):
+        size = self.grid.tiles.tile_size
+        margin = self.margin
+        my0 = tile_my * size - margin
+        mx0 = tile_mx * size - margin
+        raw = self.grid.stored_log_odds(my0, mx0, (size + 2 * margin, size + 2 * margin))
+        occupied = raw > self.grid.log_odds_codec.encode(self.occupied_log_odds)
+        if not occupied.any():
+            if (tile_my, tile_mx) in self.field.slots:
+                self.field.pools['distance'][self.field.slots[(tile_my, tile_mx)]] = self.max_distance
+            return
+        
+        distance = distance_transform_edt(~occupied) * self.grid.resolution
+        interior = np.minimum(distance[margin:margin + size, margin:margin + size], self.max_distance)
+        slot = self.field.address(np.array([tile_my * size]), np.array([tile_mx * size]))[0] >> (2 * self.field.shift)
+        self.field.pools['distance'][slot] = interior
+    
+    def _sample(self, world_points: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Bilinearly interpolated distance and its (x, y) gradient at world points"""
+        grid = self.grid
+        u = (world_points[:, 0] - grid.origin[0]) / grid.resolution - 0.5
+        v = (world_points[:, 1] - grid.origin[1]) / grid.resolution - 0.5
+        mx = np.floor(u).astype(np.int64)
+        my = np.floor(v).astype(np.int64)
+        fx = u - mx
+        fy = v - my
+        
+        # Corner values (0,0), (1,0), (0,1), (1,1) in one lookup
+        n = len(world_points)
+        corners = self.field.gather('distance', np.concatenate([my, my, my + 1, my + 1]),
+                                    np.concatenate([mx, mx + 1, mx, mx + 1])).astype(np.float64)
+        d00, d10, d01, d11 = corners[:n], corners[n:2*n], corners[2*n:3*n], corners[3*n:]
+        
+        distance = (d00 * (1 - fx) * (1 - fy) + d10 * fx * (1 - fy) +
+                    d01 * (1 - fx) * fy + d11 * fx * fy)
+        grad_x = ((d10 - d00) * (1 - fy) + (d11 - d01) * fy) / grid.resolution
+        grad_y = ((d01 - d00) * (1 - fx) + (d11 - d10) * fx) / grid.resolution
+        return distance, np.column_stack([grad_x, grad_y])
+    
+    def distance(self, world_points: np.ndarray) -> np.ndarray:
+        """Interpolated distance to the nearest obstacle at world points"""
+        self.update()
+        return self._sample(world_points)[0]
+    
+    def score(self, points: np.ndarray, pose: Pose2D) -> float:
+        """Mean likelihood of sensor-frame points placed at pose"""
+        return self.score_and_gradient(points, pose)[0]
+    
+    def score_and_gradient(self, points: np.ndarray, pose: Pose2D) -> Tuple[float, np.ndarray]:
+        """
+        Mean likelihood of sensor-frame points placed at pose, and its gradient
+        
+        Returns:
+            (score, gradient) with gradient w.r.t. (x, y, theta)
+        """
+        if len(points) == 0:
+            return 0.0, np.zeros(3)
+        self.update()
+        world = se2.transform_points((pose.x, pose.y, pose.theta), points)
+        distance, grad = self._sample(world)
+        c = math.cos(pose.theta)
+        s = math.sin(pose.theta)
+        
+        likelihood = np.exp(-distance ** 2 / (2 * self.sigma ** 2))
+        # d likelihood / d world point, then chain through the pose
+        dl = (-likelihood * distance / self.sigma ** 2)[:, None] * grad
+        dtheta = (dl[:, 0] * (-s * points[:, 0] - c * points[:, 1]) +
+                  dl[:, 1] * (c * points[:, 0] - s * points[:, 1]))
+        gradient = np.array([dl[:, 0].sum(), dl[:, 1].sum(), dtheta.sum()]) / len(points)
+        return float(likelihood.mean()), gradient
+
+class LocalPointMap:
+    """
+    Rolling point map of the last few keyframes in world coordinates, for scan-to-map ICP
+    
+    Points are hashed into voxels (one point per voxel, the first to land
+    there); each voxel counts the kept keyframes that observed it, so
+    inserting a keyframe and evicting the oldest only touch their own
+    voxels. The KD-tree (and normals) over the live points is rebuilt
+    lazily after a change, so at most once per keyframe, over a map whose
+    size is bounded by max_keyframes.
+    """
+    
+    def __init__(self, voxel_size: float = 0.05, max_keyframes: int = 10):
+        self.voxel_size = voxel_size
+        self.max_keyframes = max_keyframes
+        self.clear()
+    
+    def clear(self):
+        """Drop all keyframes and points"""
+        # voxel -> point slot; tiles are small as the map only covers the recent trajectory
+        self.voxels = TiledGrid(tile_size=16, layers={'slot': (np.int64, -1)})
+        self.points = np.zeros((0, 2))  # slot -> world point
+        self.counts = np.zeros(0, dtype=np.int64)  # slot -> keyframes observing its voxel
+        self.addresses = np.zeros(0, dtype=np.int64)  # slot -> voxel address
+        self.num_slots = 0
+        self.free_slots = np.zeros(0, dtype=np.int64)
+        self.keyframes: 'deque[Tuple[int, np.ndarray]]' = deque()  # (pose index, slots)
+        self._live = None
+        self._tree = None
+        self._normals = None
+    
+    def __len__(self) -> int:
+        return self.num_slots - len(self.free_slots)
+    
+    @property
+    def keyframe_indices(self) -> List[int]:
+        return [idx for idx, _ in self.keyframes]
+    
+    def _allocate(self, count: int) -> np.ndarray:
+        """Slots for count new points, reusing freed ones first"""
+        reused = self.free_slots[:count]
+        self.free_slots = self.free_slots[count:]
+        fresh = np.arange(self.num_slots, self.num_slots + count - len(reused))
+        self.num_slots += len(fresh)
+        if self.num_slots > len(self.points):
+            capacity = max(2 * len(self.points), self.num_slots, 1024)
+            self.points = np.concatenate([self.points, np.zeros((capacity - len(self.points), 2))])
+            self.counts = np.concatenate([self.counts, np.zeros(capacity - len(self.counts), dtype=np.int64)])
+            self.addresses = np.concatenate([self.addresses,
+                                             np.zeros(capacity - len(self.addresses), dtype=np.int64)])
+        return np.concatenate([reused, fresh])
+    
+    def insert(self, idx: int, world_points: np.ndarray):
+        """Add keyframe idx's points (world frame), evicting the oldest keyframe when full"""
+        cells = np.floor(world_points / self.voxel_size).astype(np.int64)
+        address, first = np.unique(self.voxels.address(cells[:, 0], cells[:, 1]), return_index=True)
+        slot_layer = self.voxels.layer('slot')
+        slots = slot_layer[address]
+        
+        # Voxels nobody has observed yet get a new point
+        new = slots < 0
+        slots[new] = self._allocate(int(new.sum()))
+        self.points[slots[new]] = world_points[first[new]]
+        self.addresses[slots[new]] = address[new]
+        slot_layer[address[new]] = slots[new]
+        self.counts[slots] += 1
+        self.keyframes.append((idx, slots))
+        
+        while len(self.keyframes) > self.max_keyframes:
+            self._evict()
+        self._live = self._tree = self._normals = None
+    
+    def _evict(self):
+        """Drop the oldest keyframe and the voxels only it observed"""
+        _, slots = self.keyframes.popleft()
+        self.counts[slots] -= 1
+        dead = slots[self.counts[slots] == 0]
+        self.voxels.layer('slot')[self.addresses[dead]] = -1
+        self.free_slots = np.concatenate([self.free_slots, dead])
+    
+    def get_points(self) -> np.ndarray:
+        """Live map points, (N, 2) in world frame"""
+        if self._live is None:
+            self._live = self.points[np.flatnonzero(self.counts[:self.num_slots] > 0)]
+        return self._live
+    
+    def get_tree(self) -> KDTree:
+        if self._tree is None:
+            self._tree = KDTree(self.get_points())
+        return self._tree
+    
+    def get_normals(self) -> np.ndarray:
+        if self._normals is None:
+            self._normals = estimate_normals(self.get_points())
+        return self._normals
+
+def pose_moved(old: Pose2D, new: Pose2D, translation_tolerance: float, rotation_tolerance: float) -> bool:
+    """True if new differs from old by more than the given tolerances"""
+    dtheta = se2.normalize_angle(new.theta - old.theta)
+    return (np.hypot(new.x - old.x, new.y - old.y) > translation_tolerance or
+            abs(dtheta) > rotation_tolerance)
+
+class Submap:
+    """Local hit-count grid fused from consecutive scans, anchored to a keyframe pose"""
+    
+    def __init__(self, anchor_idx: int, resolution: float, tile_size: int = 16):
+        self.anchor_idx = anchor_idx
+        self.scan_indices: List[int] = []
+        self.resolution = resolution
+        
+        # Net hit counts (occupied minus free) in the anchor frame, cell
+        # (sy, sx) covering [sx, sx + 1) x [sy, sy + 1) * resolution. Tiles are
+        # allocated as scans reach them, so the grid stays as small as its scans
+        self.tiles = TiledGrid(tile_size, {'net': (np.int16, 0)})
+    
+    def to_cell(self, v: np.ndarray) -> np.ndarray:
+        """Cell index of anchor-frame coordinates"""
+        return np.floor(v / self.resolution).astype(np.int64)
+    
+    def insert(self, idx: int, relative_pose: Pose2D, scan: LidarScan, ray_caster: BatchRayCaster):
+        """Ray-cast a scan taken at relative_pose (in the anchor frame) into the submap"""
+        valid_mask = scan.valid_mask()
+        ranges = scan.ranges[valid_mask]
+        beam_angles = relative_pose.theta + scan.angles[valid_mask]
+        end_mx = self.to_cell(relative_pose.x + ranges * np.cos(beam_angles))
+        end_my = self.to_cell(relative_pose.y + ranges * np.sin(beam_angles))
+        origin_mx = self.to_cell(np.array([relative_pose.x]))
+        origin_my = self.to_cell(np.array([relative_pose.y]))
+        
+        for cells_x, cells_y, is_end in ray_caster.iter_lines(origin_mx, origin_my, end_mx, end_my):
+            self.tiles.add('net', self.tiles.address(cells_y, cells_x), np.where(is_end, 1, -1))
+        self.scan_indices.append(idx)
+    
+    def resample(self, grid: OccupancyGridMap, anchor_pose: Pose2D) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Nearest-cell resampling of the submap into grid at anchor_pose
+        
+        Returns:
+            (mx, my, net) of the global cells whose submap count is non-zero
+        """
+        empty = np.zeros(0, dtype=np.int64)
+        if not self.tiles.num_tiles:
+            return empty, empty, empty
+        sy0, sx0, sy1, sx1 = self.tiles.bounds()
+        c = np.cos(anchor_pose.theta)
+        s = np.sin(anchor_pose.theta)
+        
+        # Global cells covered by the rotated bounding rectangle of the tiles
+        corner_x = np.array([sx0, sx1, sx0, sx1]) * self.resolution
+        corner_y = np.array([sy0, sy0, sy1, sy1]) * self.resolution
+        world_x = anchor_pose.x + c * corner_x - s * corner_y
+        world_y = anchor_pose.y + s * corner_x + c * corner_y
+        mx_lo, mx_hi = np.floor((np.array([world_x.min(), world_x.max()]) - grid.origin[0]) /
+                                 grid.resolution).astype(int)
+        my_lo, my_hi = np.floor((np.array([world_y.min(), world_y.max()]) - grid.origin[1]) /
+                                 grid.resolution).astype(int)
+        my, mx = np.mgrid[my_lo:my_hi + 1, mx_lo:mx_hi + 1]
+        mx = mx.ravel()
+        my = my.ravel()
+        
+        # Pull each global cell center back into the submap frame
+        dx = grid.origin[0] + (mx + 0.5) * grid.resolution - anchor_pose.x
+        dy = grid.origin[1] + (my + 0.5) * grid.resolution - anchor_pose.y
+        net = self.tiles.gather('net', self.to_cell(-s * dx + c * dy), self.to_cell(c * dx + s * dy))
+        observed = net != 0
+        return mx[observed], my[observed], net[observed]
+
+class SubmapCollection:
+    """
+    Submaps of a trajectory, composited into a global OccupancyGridMap on demand
+    
+    Scans are fused into the active submap relative to its anchor. Rendering
+    transforms each submap by the current (optimized) anchor pose, so pose
+    graph corrections only re-place submaps instead of re-casting rays.
+    """
+    
+    def __init__(self, grid: OccupancyGridMap, scans_per_submap: int = 10,
+                 translation_tolerance: float = 0.0, rotation_tolerance: float = 0.0):
+        self.grid = grid
+        self.scans_per_submap = scans_per_submap
+        self.translation_tolerance = translation_tolerance
+        self.rotation_tolerance = rotation_tolerance
+        self.submaps: List[Submap] = []
+        # Submap number -> anchor pose it was added to the grid at; resampling
+        # there again gives exactly the cells to subtract
+        self.placements: Dict[int, Pose2D] = {}
+        self.ray_caster = BatchRayCaster()
+    
+    def insert(self, idx: int, poses: List[Pose2D], scan: LidarScan):
+        """Fuse scan idx into the active submap, starting a new one when it is full"""
+        if not self.submaps or len(self.submaps[-1].scan_indices) >= self.scans_per_submap:
+            self.submaps.append(Submap(idx, self.grid.resolution))
+        number = len(self.submaps) - 1
+        submap = self.submaps[number]
+        # Take the submap out of the grid while it still matches its placement
+        self._remove(number)
+        relative_pose = poses[idx].relative_to(poses[submap.anchor_idx])
+        submap.insert(idx, relative_pose, scan, self.ray_caster)
+    
+    def render(self, poses: List[Pose2D], full: bool = False):
+        """Place submaps that are not in the grid, or whose anchor moved since they were placed"""
+        if full:
+            self.grid.clear()
+            self.placements.clear()
+        
+        for number, submap in enumerate(self.submaps):
+            anchor_pose = poses[submap.anchor_idx]
+            placed_at = self.placements.get(number)
+            if placed_at is not None:
+                if not pose_moved(placed_at, anchor_pose, self.translation_tolerance,
+                                  self.rotation_tolerance):
+                    continue
+                self._remove(number)
+            mx, my, net = submap.resample(self.grid, anchor_pose)
+            self.grid.add_net(mx, my, net)
+            self.placements[number] = anchor_pose
+    
+    def _remove(self, number: int):
+        """Subtract a placed submap from the grid"""
+        placed_at = self.placements.pop(number, None)
+        if placed_at is not None:
+            mx, my, net = self.submaps[number].resample(self.grid, placed_at)
+            self.grid.add_net(mx, my, net, weight=-1)
 
-class BresenhamRayCast:
-    """Bresenham's line algorithm for ray casting"""
+def verify_loop_closure(icp: ICP, matcher: Optional[CorrelativeScanMatcher],
+                        source: np.ndarray, target: np.ndarray, guess: Pose2D,
+                        target_key=None, **align_kwargs) -> Tuple[Pose2D, float, bool]:
+    """
+    Match a loop-closure candidate: optional correlative search, then ICP
+    
+    align_kwargs pass cached target_tree / normals on to icp.align.
+    
+    Returns:
+        (relative_pose, fitness, converged) as from ICP.align
+    """
+    if matcher is not None:
+        guess, score, matched = matcher.match(source, target, guess, target_key=target_key)
+        if not matched:
+            return guess, 0.0, False
+    return icp.align(source, target, guess, **align_kwargs)
+
+class SharedPointStore:
+    """
+    Store of local scan points in shared memory, read by worker processes
+    
+    Entries are dropped together with the scan cache (see discard), and
+    the space they held is reclaimed by compacting the block on add.
+    """
+    
+    def __init__(self, capacity: int = 65536):
+        self.capacity = capacity  # In points
+        self.size = 0  # End of the used part of the block
+        self.live = 0  # Points of the stored scans
+        self.offsets: Dict[int, Tuple[int, int]] = {}  # idx -> (first point, count)
+        self._shm = shared_memory.SharedMemory(create=True, size=capacity * 2 * 8)
+        self._finalizer = weakref.finalize(self, SharedPointStore._release, self._shm)
     
     @staticmethod
-    def get_line(x0: int, y0: int, x1: int, y1: int) -> List[Tuple[int, int]]:
-        cells = []
-        dx = abs(x1 - x0)
-        dy = abs(y1 - y0)
-        sx = 1 if x0 < x1 else -1
-        sy = 1 if y0 < y1 else -1
-        err = dx - dy
-        x, y = x0, y0
-        
-        while True:
-            cells.append((x, y))
-            if x == x1 and y == y1:
-                break
-            e2 = 2 * err
-            if e2 > -dy:
-                err -= dy
-                x += sx
-            if e2 < dx:
-                err += dx
-                y += sy
-        return cells
+    def _release(shm: shared_memory.SharedMemory):
+        shm.close()
+        shm.unlink()
+    
+    @property
+    def name(self) -> str:
+        return self._shm.name
+    
+    def _array(self) -> np.ndarray:
+        return np.ndarray((self.capacity, 2), dtype=np.float64, buffer=self._shm.buf)
+    
+    def _compact(self, capacity: int):
+        """Move the stored scans to the front of a block of the given capacity"""
+        source = self._array()
+        if capacity == self.capacity:
+            target, shm = source, None
+        else:
+            shm = shared_memory.SharedMemory(create=True, size=capacity * 2 * 8)
+            target = np.ndarray((capacity, 2), dtype=np.float64, buffer=shm.buf)
+        
+        # In first-point order, so in-place moves only go towards the front
+        size = 0
+        for idx, (first, count) in sorted(self.offsets.items(), key=lambda item: item[1][0]):
+            target[size:size + count] = source[first:first + count]
+            self.offsets[idx] = (size, count)
+            size += count
+        self.size = size
+        
+        if shm is not None:
+            self._finalizer()
+            self._shm = shm
+            self.capacity = capacity
+            self._finalizer = weakref.finalize(self, SharedPointStore._release, self._shm)
+    
+    def add(self, idx: int, points: np.ndarray):
+        """Append the points of scan idx, compacting or moving to a larger block if needed"""
+        self.discard(idx)
+        if self.size + len(points) > self.capacity:
+            # Compact in place while at most half the block is needed,
+            # so repeated adds do not compact every time
+            required = self.live + len(points)
+            self._compact(self.capacity if 2 * required <= self.capacity else 2 * required)
+        self._array()[self.size:self.size + len(points)] = points
+        self.offsets[idx] = (self.size, len(points))
+        self.size += len(points)
+        self.live += len(points)
+    
+    def discard(self, idx: int):
+        """Drop the points of scan idx, if stored"""
+        entry = self.offsets.pop(idx, None)
+        if entry is not None:
+            self.live -= entry[1]
+    
+    def close(self):
+        self._finalizer()
+
+# Per-process state of loop-closure workers
+_worker_state: Dict[str, object] = {}
+
+def _init_loop_closure_worker():
+    _worker_state['matcher'] = None
+    _worker_state['shm'] = None
+
+def _worker_matcher(matcher: Optional[CorrelativeScanMatcher]) -> Optional[CorrelativeScanMatcher]:
+    """The task's matcher, or the worker's own while the settings match (it keeps its pyramids)"""
+    cached = _worker_state['matcher']
+    if matcher is None or cached is None or cached.__getstate__() != matcher.__getstate__():
+        _worker_state['matcher'] = cached = matcher
+    return cached
+
+def _worker_points(shm_name: str, capacity: int, offset: int, count: int) -> np.ndarray:
+    """Copy of a scan's points from the shared store (attached once per block)"""
+    shm = _worker_state['shm']
+    if shm is None or shm.name != shm_name:
+        if shm is not None:
+            shm.close()
+        shm = shared_memory.SharedMemory(name=shm_name)
+        _worker_state['shm'] = shm
+    store = np.ndarray((capacity, 2), dtype=np.float64, buffer=shm.buf)
+    return store[offset:offset + count].copy()
+
+def _verify_loop_closure_task(task: tuple) -> Tuple[int, Tuple[float, float, float], float, bool, Tuple[int, int]]:
+    """
+    Worker entry point: verify one candidate given shared-store offsets
+    
+    The task carries the caller's current icp and matcher, so settings
+    changed between calls apply. Also returns the ICP statistics of the
+    task (num_queries, num_alignments) for the caller to add up.
+    """
+    shm_name, capacity, old_idx, source_slice, target_slice, guess, source_keep, icp, matcher = task
+    icp.num_queries = icp.num_alignments = 0
+    source = _worker_points(shm_name, capacity, *source_slice)
+    source_kwargs = {}
+    if icp.uses_normals:
+        # Normals of the full scan, as in the serial path
+        source_kwargs['source_normals'] = estimate_normals(source, ordered=True)
+    if source_keep is not None:
+        # Downsampled in the main process, only the kept indices are sent
+        source = source[source_keep]
+        if icp.uses_normals:
+            source_kwargs['source_normals'] = source_kwargs['source_normals'][source_keep]
+    target = _worker_points(shm_name, capacity, *target_slice)
+    pose, fitness, converged = verify_loop_closure(
+        icp, _worker_matcher(matcher), source, target,
+        Pose2D(*guess), target_key=old_idx, **source_kwargs
+    )
+    return (old_idx, (float(pose.x), float(pose.y), float(pose.theta)), fitness, converged,
+            (icp.num_queries, icp.num_alignments))
+
+def _rasterize_task(task: tuple) -> int:
+    """Worker entry point: cast a share of the rays into its own count grids in shared memory"""
+    shm_name, shape, part, mx0, my0, origin_mx, origin_my, end_mx, end_my, max_cells_per_batch = task
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        counts = np.ndarray(shape, dtype=np.int32, buffer=shm.buf)[part]
+        occ = counts[0].reshape(-1)
+        free = counts[1].reshape(-1)
+        ray_caster = BatchRayCaster(max_cells_per_batch)
+        for cells_x, cells_y, is_end in ray_caster.iter_lines(origin_mx, origin_my, end_mx, end_my):
+            flat = (cells_y - my0) * shape[3] + (cells_x - mx0)
+            np.add.at(occ, flat[is_end], 1)
+            np.add.at(free, flat[~is_end], 1)
+        del counts, occ, free
+    finally:
+        shm.close()
+    return len(end_mx)
+
+class ParallelRasterizer:
+    """
+    Ray casting of many scans' rays across a process pool
+    
+    The rays are split into one share per worker, balanced by cell count.
+    Each worker accumulates the occupied/free hit counts of its share into
+    its own int32 grid pair in shared memory, covering the bounding box of
+    all rays, and the grids are summed. Counts are integers, so the result
+    is exactly what casting the rays serially gives.
+    """
+    
+    def __init__(self, workers: int, max_cells_per_batch: int = 2_000_000):
+        self.workers = workers
+        self.max_cells_per_batch = max_cells_per_batch
+        self._pool = None
+    
+    def count(self, origin_mx: np.ndarray, origin_my: np.ndarray,
+              end_mx: np.ndarray, end_my: np.ndarray) -> Tuple[int, int, np.ndarray, np.ndarray]:
+        """
+        Summed hit counts of the rays (origin -> end, end cell occupied)
+        
+        Returns:
+            (mx0, my0, occ, free), dense int32 [my, mx] grids whose [0, 0] is cell (mx0, my0)
+        """
+        # Bresenham cells stay within the bounding box of the ray ends
+        mx0 = int(min(origin_mx.min(), end_mx.min()))
+        my0 = int(min(origin_my.min(), end_my.min()))
+        width = int(max(origin_mx.max(), end_mx.max())) - mx0 + 1
+        height = int(max(origin_my.max(), end_my.max())) - my0 + 1
+        
+        # Contiguous shares of about the same number of cells
+        cells = np.maximum(np.abs(end_mx - origin_mx), np.abs(end_my - origin_my)) + 1
+        bounds = np.searchsorted(np.cumsum(cells), np.linspace(0, cells.sum(), self.workers + 1)[1:-1])
+        bounds = np.concatenate(([0], bounds, [len(cells)]))
+        
+        shape = (self.workers, 2, height, width)
+        shm = shared_memory.SharedMemory(create=True, size=int(np.prod(shape)) * 4)
+        try:
+            grids = np.ndarray(shape, dtype=np.int32, buffer=shm.buf)
+            grids[:] = 0
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(max_workers=self.workers)
+            tasks = [(shm.name, shape, part, mx0, my0, origin_mx[lo:hi], origin_my[lo:hi],
+                      end_mx[lo:hi], end_my[lo:hi], self.max_cells_per_batch)
+                     for part, (lo, hi) in enumerate(zip(bounds[:-1], bounds[1:]))]
+            list(self._pool.map(_rasterize_task, tasks))
+            total = grids.sum(axis=0, dtype=np.int32)
+            del grids
+        finally:
+            shm.close()
+            shm.unlink()
+        return mx0, my0, total[0], total[1]
+    
+    def close(self):
+        """Shut down the worker pool"""
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+@dataclass
+class KeyframePolicy:
+    """Decides which scans become pose-graph nodes"""
+    min_translation: float = 0.2  # meters moved since the last keyframe
+    min_rotation: float = 0.2  # radians turned since the last keyframe
+    max_interval: float = 5.0  # seconds since the last keyframe
+    min_overlap: float = 0.5  # fraction of points still matching the last keyframe
+    
+    def is_keyframe(self, last_pose: Pose2D, pose: Pose2D, elapsed: float,
+                    overlap: Optional[float] = None) -> bool:
+        """
+        Check the thresholds against the last keyframe
+        
+        Args:
+            last_pose: Pose of the last keyframe
+            pose: Current pose estimate
+            elapsed: Time since the last keyframe in seconds
+            overlap: Fraction of current points near the last keyframe's points, if known
+        """
+        relative = pose.relative_to(last_pose)
+        if np.hypot(relative.x, relative.y) >= self.min_translation:
+            return True
+        if abs(relative.theta) >= self.min_rotation:
+            return True
+        if elapsed >= self.max_interval:
+            return True
+        return overlap is not None and overlap < self.min_overlap
 
 class GraphSLAM:
     """Graph-based SLAM with ICP and pose graph optimization"""
     
     def __init__(self, map_width: int = 500, map_height: int = 500,
-                 resolution: float = 0.05, origin: Tuple[float, float] = (-12.5, -12.5)):
-        self.map = OccupancyGridMap(map_width, map_height, resolution, origin)
-        self.pose_graph = PoseGraph()
-        self.icp = ICP(max_iterations=50, tolerance=1e-5, max_correspondence_distance=0.3)
-        self.ray_caster = BresenhamRayCast()
-        
+                 resolution: float = 0.05, origin: Tuple[float, float] = (-12.5, -12.5),
+                 use_submaps: bool = False, scans_per_submap: int = 10,
+                 loop_closure_matcher: str = "icp", loop_closure_workers: int = 0,
+                 keyframe_policy: Optional[KeyframePolicy] = None,
+                 optimization_mode: str = "full", optimization_window: int = 50,
+                 map_log_odds_dtype=np.float64, scan_matcher: str = "point_to_point",
+                 odometry_downsampler: Optional[ScanDownsampler] = None,
+                 loop_closure_downsampler: Optional[ScanDownsampler] = None,
+                 multi_resolution_icp: bool = False, local_map_keyframes: int = 0,
+                 ray_templates: bool = False, map_workers: int = 0):
         # Parameters
         self.loop_closure_distance_threshold = 2.0  # meters
         self.loop_closure_fitness_threshold = 0.6  # ICP fitness score
         self.min_scans_between_loop_closure = 20  # Avoid checking recent scans
         
+        self.map = OccupancyGridMap(map_width, map_height, resolution, origin,
+                                    log_odds_dtype=map_log_odds_dtype)
+        # Scan-to-map scoring against self.map, refreshed lazily where the map changed
+        self.likelihood_field = LikelihoodField(self.map)
+        self.pose_graph = PoseGraph(index_cell_size=self.loop_closure_distance_threshold)
+        # Scan matcher for odometry refinement and loop closures:
+        # "point_to_point" (SVD) or "point_to_line" (with normals)
+        if scan_matcher == "point_to_point":
+            self.icp = ICP(max_iterations=50, tolerance=1e-5, max_correspondence_distance=0.3)
+        elif scan_matcher == "point_to_line":
+            self.icp = PointToLineICP(max_iterations=50, tolerance=1e-5, max_correspondence_distance=0.3)
+        else:
+            raise ValueError(f"Unknown scan matcher: {scan_matcher}")
+        if multi_resolution_icp:
+            self.icp.levels = ICP.coarse_to_fine_levels(self.icp.max_correspondence_distance)
+        
+        # Optional thinning of the source scan before matching (targets stay
+        # dense); separate stages for odometry refinement and loop closures
+        self.odometry_downsampler = odometry_downsampler
+        self.loop_closure_downsampler = loop_closure_downsampler
+        # ray_templates copies rays from the process-wide template cache
+        # (shared with Build_OGM) instead of computing them
+        self.ray_caster = BatchRayCaster(templates=shared_ray_templates() if ray_templates else None)
+        
+        # Odometry refinement target: the last keyframe's scan, or (when
+        # local_map_keyframes > 0) a rolling point map of that many keyframes
+        self.local_map = None
+        if local_map_keyframes > 0:
+            self.local_map = LocalPointMap(voxel_size=resolution, max_keyframes=local_map_keyframes)
+        
+        # Loop-closure matcher: "icp" (from the odometry guess) or
+        # "correlative" (branch-and-bound search, then ICP refinement)
+        if loop_closure_matcher not in ("icp", "correlative"):
+            raise ValueError(f"Unknown loop closure matcher: {loop_closure_matcher}")
+        self.loop_closure_matcher = loop_closure_matcher
+        self.correlative_matcher = CorrelativeScanMatcher(resolution=resolution)
+        
+        # Parallel candidate verification (0 or 1 worker keeps it serial)
+        self.loop_closure_workers = loop_closure_workers
+        self.parallel_min_candidates = 4  # Fewer candidates are verified serially
+        self._loop_closure_pool = None
+        self._point_store = None
+        if loop_closure_workers > 1:
+            # Holds the scans of the scan cache, evicted along with it
+            self._point_store = SharedPointStore()
+            self.pose_graph.scan_cache.on_evict = self._point_store.discard
+        
+        # Keyframe selection (None adds every scan to the graph)
+        self.keyframe_policy = keyframe_policy
+        self.current_pose: Optional[Pose2D] = None  # Latest estimate, keyframe or not
+        self.last_keyframe_time = 0.0
+        self.num_scans_processed = 0
+        
         # Information matrices (inverse covariance)
         self.odometry_information = np.diag([100.0, 100.0, 50.0])  # x, y, theta
         self.loop_closure_information = np.diag([200.0, 200.0, 100.0])  # Higher confidence
@@ -363,8 +1805,39 @@ class GraphSLAM:
         # Track when last optimization occurred
         self.last_optimization_size = 0
         self.optimization_interval = 10  # Optimize every N poses
+        
+        # Back-end mode between loop closures: "full" re-solves the whole graph,
+        # "incremental" only the poses affected by new constraints and
+        # "sliding_window" the last optimization_window poses.
+        # An accepted loop closure always triggers a full solve.
+        if optimization_mode not in ("full", "incremental", "sliding_window"):
+            raise ValueError(f"Unknown optimization mode: {optimization_mode}")
+        self.optimization_mode = optimization_mode
+        self.optimization_window = optimization_window
+        
+        # Map rebuilds with many rays are cast on map_workers processes (0 or 1 keeps it serial)
+        self.map_rasterizer = ParallelRasterizer(map_workers) if map_workers > 1 else None
+        self.parallel_min_rays = 20000  # Fewer rays are cast serially
+        
+        # After optimization only scans whose pose moved more than this are re-cast
+        self.map_translation_tolerance = resolution / 2  # meters
+        # radians, half a cell at the lidar's max range
+        self.map_rotation_tolerance = resolution / (2 * LidarScan.max_range)
+        self.scan_contributions: Dict[int, ScanContribution] = {}
+        # Graph scans not yet cast into the map
+        self._unmapped_scans = set()
+        
+        # Optional submap layer: scans are fused into local grids and the
+        # global map is composited from them when requested
+        self.submaps = None
+        if use_submaps:
+            self.submaps = SubmapCollection(self.map, scans_per_submap,
+                                            self.map_translation_tolerance,
+                                            self.map_rotation_tolerance)
+            self.submaps.ray_caster = self.ray_caster
     
-    def process_scan(self, pose: Pose2D, scan: LidarScan, use_icp: bool = True):
+    def process_scan(self, pose: Pose2D, scan: LidarScan, use_icp: bool = True,
+                     timestamp: Optional[float] = None) -> bool:
         """
         Process a new lidar scan with optional ICP refinement
         
@@ -372,20 +1845,46 @@ class GraphSLAM:
             pose: Initial pose estimate (e.g., from odometry)
             scan: Lidar scan data
             use_icp: Whether to refine pose using ICP
+            timestamp: Scan time in seconds for the keyframe policy (defaults to now)
+            
+        Returns:
+            True if the scan was added to the graph as a keyframe
         """
         refined_pose = pose
+        scan_local = scan.get_points(Pose2D(0, 0, 0))
+        fitness = None
+        self.num_scans_processed += 1
+        if timestamp is None:
+            timestamp = time.time()
         
         # If this is not the first scan, use ICP to refine the pose
         if use_icp and len(self.pose_graph.poses) > 0:
-            refined_pose = self._refine_pose_with_icp(pose, scan)
+            refined_pose, fitness = self._refine_pose_with_icp(pose, scan, scan_local)
+        self.current_pose = refined_pose
+        
+        # Non-keyframes only update the current pose estimate
+        if self.keyframe_policy is not None and len(self.pose_graph.poses) > 0:
+            overlap = fitness
+            if overlap is None and self.keyframe_policy.min_overlap > 0:
+                overlap = self._scan_overlap(refined_pose, scan_local)
+            if not self.keyframe_policy.is_keyframe(self.pose_graph.poses[-1], refined_pose,
+                                                    timestamp - self.last_keyframe_time, overlap):
+                return False
+        self.last_keyframe_time = timestamp
         
         # Add pose and scan to graph
         pose_idx = len(self.pose_graph.poses)
-        self.pose_graph.add_pose(refined_pose, scan)
+        self.pose_graph.add_pose(refined_pose, scan, local_points=scan_local)
+        if self.submaps is None:
+            self._unmapped_scans.add(pose_idx)
+        if self._point_store is not None:
+            self._point_store.add(pose_idx, scan_local)
+        if self.local_map is not None:
+            self.local_map.insert(pose_idx, se2.transform_points(refined_pose.to_vector(), scan_local))
         
         # Add odometry constraint from previous pose
         if pose_idx > 0:
-            relative_transform = self.pose_graph.poses[pose_idx - 1].inverse().compose(refined_pose)
+            relative_transform = refined_pose.relative_to(self.pose_graph.poses[pose_idx - 1])
             constraint = PoseConstraint(
                 from_idx=pose_idx - 1,
                 to_idx=pose_idx,
@@ -396,147 +1895,350 @@ class GraphSLAM:
             self.pose_graph.add_constraint(constraint)
         
         # Detect and add loop closures
-        self._detect_loop_closures(pose_idx, scan)
+        num_loop_closures = self._detect_loop_closures(pose_idx, scan)
         
-        # Periodically optimize the pose graph
-        if len(self.pose_graph.poses) - self.last_optimization_size >= self.optimization_interval:
+        if self.submaps is not None:
+            self.submaps.insert(pose_idx, self.pose_graph.poses, scan)
+        
+        # Periodically optimize the pose graph, and globally after a loop closure
+        full_solve = self.optimization_mode == "full" or num_loop_closures > 0
+        if (num_loop_closures > 0 and self.optimization_mode != "full" or
+                len(self.pose_graph.poses) - self.last_optimization_size >= self.optimization_interval):
             print(f"Optimizing pose graph with {len(self.pose_graph.poses)} poses...")
-            success = self.pose_graph.optimize()
+            if full_solve:
+                success = self.pose_graph.optimize()
+            elif self.optimization_mode == "incremental":
+                success = self.pose_graph.optimize_incremental()
+            else:
+                success = self.pose_graph.optimize_window(self.optimization_window)
             if success:
                 print("Optimization successful!")
                 self.last_optimization_size = len(self.pose_graph.poses)
                 # Rebuild map after optimization
                 self._rebuild_map()
+                self._rebuild_local_map()
             else:
                 print("Optimization failed!")
-        else:
+        elif self.submaps is None:
             # Just update map incrementally
-            self._update_map_with_scan(refined_pose, scan)
+            self._update_map_with_scan(pose_idx)
+        return True
     
-    def _refine_pose_with_icp(self, initial_pose: Pose2D, current_scan: LidarScan) -> Pose2D:
-        """Refine pose estimate using ICP against recent scans"""
+    def _refine_pose_with_icp(self, initial_pose: Pose2D, current_scan: LidarScan,
+                              current_local: np.ndarray = None) -> Tuple[Pose2D, Optional[float]]:
+        """
+        Refine pose estimate using ICP against the last keyframe (or the local map)
+        
+        Returns:
+            (pose, fitness), fitness is None when ICP was not run
+        """
         if len(self.pose_graph.poses) == 0:
-            return initial_pose
+            return initial_pose, None
+        if self.local_map is not None:
+            return self._refine_pose_with_local_map(initial_pose, current_scan, current_local)
         
         # Get the most recent scan
-        prev_pose = self.pose_graph.poses[-1]
-        prev_scan = self.pose_graph.scans[-1]
+        prev_idx = len(self.pose_graph.poses) - 1
+        prev_pose = self.pose_graph.poses[prev_idx]
         
-        # Convert scans to point clouds
-        current_points = current_scan.get_points(initial_pose)
-        prev_points = prev_scan.get_points(prev_pose)
+        # Scans as point clouds in their local frames
+        if current_local is None:
+            current_local = current_scan.get_points(Pose2D(0, 0, 0))
+        prev_local = self.pose_graph.get_scan_points(prev_idx)
         
-        if len(current_points) < 10 or len(prev_points) < 10:
-            return initial_pose
+        if len(current_local) < 10 or len(prev_local) < 10:
+            return initial_pose, None
         
         # Compute initial relative transformation guess
-        relative_guess = prev_pose.inverse().compose(initial_pose)
+        relative_guess = initial_pose.relative_to(prev_pose)
         
-        # Run ICP in the local frame
-        current_local = current_scan.get_points(Pose2D(0, 0, 0))
-        prev_local = prev_scan.get_points(Pose2D(0, 0, 0))
+        current_local, source_kwargs = self._odometry_source(current_local)
         
+        # Run ICP in the local frame
         refined_relative, fitness, converged = self.icp.align(
-            current_local, prev_local, relative_guess
+            current_local, prev_local, relative_guess, **self._align_targets(prev_idx), **source_kwargs
         )
         
         if converged and fitness > 0.3:
             # Transform back to world frame
             refined_pose = prev_pose.compose(refined_relative)
-            return refined_pose
+            return refined_pose, fitness
         else:
-            return initial_pose
+            return initial_pose, fitness
     
-    def _detect_loop_closures(self, current_idx: int, current_scan: LidarScan):
-        """Detect loop closures and add constraints"""
-        if current_idx < self.min_scans_between_loop_closure:
+    def _refine_pose_with_local_map(self, initial_pose: Pose2D, current_scan: LidarScan,
+                                    current_local: np.ndarray = None) -> Tuple[Pose2D, Optional[float]]:
+        """Refine pose estimate using ICP against the local map, directly in the world frame"""
+        if current_local is None:
+            current_local = current_scan.get_points(Pose2D(0, 0, 0))
+        if len(current_local) < 10 or len(self.local_map) < 10:
+            return initial_pose, None
+        
+        current_local, source_kwargs = self._odometry_source(current_local)
+        
+        targets = {'target_tree': self.local_map.get_tree()}
+        if self.icp.uses_normals:
+            targets['target_normals'] = self.local_map.get_normals()
+        refined_pose, fitness, converged = self.icp.align(
+            current_local, self.local_map.get_points(), initial_pose, **targets, **source_kwargs
+        )
+        
+        if converged and fitness > 0.3:
+            return refined_pose, fitness
+        return initial_pose, fitness
+    
+    def _odometry_source(self, current_local: np.ndarray) -> Tuple[np.ndarray, Dict[str, np.ndarray]]:
+        """Odometry ICP source points (downsampled if configured) and icp.align source arguments"""
+        keep = slice(None)
+        if self.odometry_downsampler is not None:
+            _, keep = self.odometry_downsampler.filter(current_local, return_indices=True)
+        source_kwargs = {}
+        if self.icp.uses_normals:
+            # Normals of the full scan, at the kept points (as for loop closures)
+            source_kwargs['source_normals'] = estimate_normals(current_local, ordered=True)[keep]
+        return current_local[keep], source_kwargs
+    
+    def _rebuild_local_map(self):
+        """Re-insert the local map's keyframes at their optimized poses"""
+        if self.local_map is None:
             return
+        indices = self.local_map.keyframe_indices
+        self.local_map.clear()
+        for idx in indices:
+            pose = self.pose_graph.poses[idx]
+            self.local_map.insert(idx, se2.transform_points(pose.to_vector(),
+                                                            self.pose_graph.get_scan_points(idx)))
+    
+    def _scan_overlap(self, pose: Pose2D, scan_local: np.ndarray) -> float:
+        """Fraction of scan points within ICP correspondence distance of the last keyframe"""
+        last_idx = len(self.pose_graph.poses) - 1
+        if len(scan_local) == 0 or len(self.pose_graph.get_scan_points(last_idx)) == 0:
+            return 0.0
+        relative = pose.relative_to(self.pose_graph.poses[last_idx])
+        points = self.icp._transform_points(scan_local, relative)
+        distances, _ = self.pose_graph.get_scan_tree(last_idx).query(
+            points, distance_upper_bound=self.icp.max_correspondence_distance
+        )
+        return float(np.mean(np.isfinite(distances)))
+    
+    def _detect_loop_closures(self, current_idx: int, current_scan: LidarScan) -> int:
+        """Detect loop closures and add constraints, returns how many were added"""
+        if current_idx < self.min_scans_between_loop_closure:
+            return 0
         
         current_pose = self.pose_graph.poses[current_idx]
-        current_points = current_scan.get_points(current_pose)
+        current_local = self.pose_graph.get_scan_points(current_idx)
         
-        if len(current_points) < 10:
-            return
+        if len(current_local) < 10:
+            return 0
         
-        # Check against older poses
-        for old_idx in range(current_idx - self.min_scans_between_loop_closure):
-            old_pose = self.pose_graph.poses[old_idx]
-            
-            # Check distance threshold
-            distance = np.sqrt((current_pose.x - old_pose.x)**2 + 
-                             (current_pose.y - old_pose.y)**2)
-            
-            if distance < self.loop_closure_distance_threshold:
-                # Try ICP alignment
-                old_scan = self.pose_graph.scans[old_idx]
-                old_points = old_scan.get_points(old_pose)
-                
-                if len(old_points) < 10:
-                    continue
-                
-                # Initial guess for relative transform
-                relative_guess = old_pose.inverse().compose(current_pose)
-                
-                # ICP in local frame
-                current_local = current_scan.get_points(Pose2D(0, 0, 0))
-                old_local = old_scan.get_points(Pose2D(0, 0, 0))
+        # Check against older poses within the distance threshold
+        candidates = self.pose_graph.spatial_index.query(
+            current_pose.x, current_pose.y, self.loop_closure_distance_threshold,
+            max_index=current_idx - self.min_scans_between_loop_closure
+        )
+        candidates = [old_idx for old_idx in candidates.tolist()
+                      if len(self.pose_graph.get_scan_points(old_idx)) >= 10]
+        
+        # Initial guesses for relative transforms
+        guesses = [current_pose.relative_to(self.pose_graph.poses[old_idx])
+                   for old_idx in candidates]
+        
+        if self._point_store is not None and len(candidates) >= self.parallel_min_candidates:
+            results = self._verify_candidates_parallel(current_idx, candidates, guesses)
+        else:
+            results = self._verify_candidates_serial(current_idx, candidates, guesses)
+        
+        # Merge in candidate order, so the graph is the same either way
+        num_added = 0
+        for old_idx, (refined_relative, fitness, converged) in zip(candidates, results):
+            if converged and fitness > self.loop_closure_fitness_threshold:
+                print(f"Loop closure detected! Pose {current_idx} <-> {old_idx} "
+                      f"(fitness: {fitness:.3f})")
                 
-                refined_relative, fitness, converged = self.icp.align(
-                    current_local, old_local, relative_guess
+                # Add loop closure constraint
+                constraint = PoseConstraint(
+                    from_idx=old_idx,
+                    to_idx=current_idx,
+                    transform=refined_relative,
+                    information=self.loop_closure_information,
+                    constraint_type="loop_closure"
                 )
-                
-                if converged and fitness > self.loop_closure_fitness_threshold:
-                    print(f"Loop closure detected! Pose {current_idx} <-> {old_idx} "
-                          f"(fitness: {fitness:.3f})")
-                    
-                    # Add loop closure constraint
-                    constraint = PoseConstraint(
-                        from_idx=old_idx,
-                        to_idx=current_idx,
-                        transform=refined_relative,
-                        information=self.loop_closure_information,
-                        constraint_type="loop_closure"
-                    )
-                    self.pose_graph.add_constraint(constraint)
-    
-    def _update_map_with_scan(self, pose: Pose2D, scan: LidarScan):
-        """Update occupancy grid with a single scan"""
+                self.pose_graph.add_constraint(constraint)
+                num_added += 1
+        return num_added
+    
+    def _active_correlative_matcher(self) -> Optional[CorrelativeScanMatcher]:
+        return self.correlative_matcher if self.loop_closure_matcher == "correlative" else None
+    
+    def _verify_candidates_serial(self, current_idx: int, candidates: List[int],
+                                  guesses: List[Pose2D]) -> List[Tuple[Pose2D, float, bool]]:
+        """Match candidates one after another, reusing cached targets"""
+        current_local = self.pose_graph.get_scan_points(current_idx)
+        keep = slice(None)
+        if self.loop_closure_downsampler is not None:
+            current_local, keep = self.loop_closure_downsampler.filter(current_local, return_indices=True)
+        source_kwargs = {}
+        if self.icp.uses_normals:
+            # Normals of the full scan, at the kept points
+            source_kwargs['source_normals'] = self.pose_graph.get_scan_normals(current_idx)[keep]
+        return [verify_loop_closure(self.icp, self._active_correlative_matcher(),
+                                    current_local, self.pose_graph.get_scan_points(old_idx), guess,
+                                    target_key=old_idx, **self._align_targets(old_idx), **source_kwargs)
+                for old_idx, guess in zip(candidates, guesses)]
+    
+    def _align_targets(self, idx: int) -> Dict[str, np.ndarray]:
+        """Cached KD-tree (and normals, if the matcher uses them) of scan idx for icp.align"""
+        targets = {'target_tree': self.pose_graph.get_scan_tree(idx)}
+        if self.icp.uses_normals:
+            targets['target_normals'] = self.pose_graph.get_scan_normals(idx)
+        return targets
+    
+    def _verify_candidates_parallel(self, current_idx: int, candidates: List[int],
+                                    guesses: List[Pose2D]) -> List[Tuple[Pose2D, float, bool]]:
+        """
+        Match candidates in the process pool; points are read from shared memory
+        
+        Each task carries the current icp and matcher, and the ICP
+        statistics of the workers are added to self.icp.
+        """
+        if self._loop_closure_pool is None:
+            self._loop_closure_pool = ProcessPoolExecutor(
+                max_workers=self.loop_closure_workers,
+                initializer=_init_loop_closure_worker
+            )
+        
+        # Scans evicted from the cache (and the store) are loaded again
+        # first, then stored, so no eviction drops one of them mid-call
+        store = self._point_store
+        needed = [current_idx] + candidates
+        points = {idx: self.pose_graph.get_scan_points(idx) for idx in needed}
+        for idx in needed:
+            if idx not in store.offsets:
+                store.add(idx, points[idx])
+        
+        source_keep = None
+        if self.loop_closure_downsampler is not None:
+            _, source_keep = self.loop_closure_downsampler.filter(points[current_idx], return_indices=True)
+        
+        matcher = self._active_correlative_matcher()
+        tasks = [(store.name, store.capacity, old_idx, store.offsets[current_idx],
+                  store.offsets[old_idx], (guess.x, guess.y, guess.theta), source_keep,
+                  self.icp, matcher)
+                 for old_idx, guess in zip(candidates, guesses)]
+        results = {}
+        for old_idx, pose, fitness, converged, (queries, alignments) in \
+                self._loop_closure_pool.map(_verify_loop_closure_task, tasks):
+            results[old_idx] = (Pose2D(*pose), fitness, converged)
+            self.icp.num_queries += queries
+            self.icp.num_alignments += alignments
+        
+        # Scans the cache no longer holds leave the store again
+        for idx in needed:
+            if idx not in self.pose_graph.scan_cache.entries:
+                store.discard(idx)
+        return [results[old_idx] for old_idx in candidates]
+    
+    def close(self):
+        """Shut down the worker pools and release shared memory"""
+        if self._loop_closure_pool is not None:
+            self._loop_closure_pool.shutdown()
+            self._loop_closure_pool = None
+        if self.map_rasterizer is not None:
+            self.map_rasterizer.close()
+        if self._point_store is not None:
+            self._point_store.close()
+    
+    def _update_map_with_scan(self, idx: int):
+        """Update occupancy grid with a single scan of the pose graph"""
+        self._update_map_with_scans([idx])
+    
+    def _update_map_with_scans(self, indices: List[int]):
+        """Ray-cast a batch of pose graph scans into the map, recording each contribution"""
+        contributions = []
+        for idx in indices:
+            contribution = self._scan_rays(self.pose_graph.poses[idx], self.pose_graph.scans[idx])
+            self.scan_contributions[idx] = contribution
+            self._unmapped_scans.discard(idx)
+            contributions.append(contribution)
+        self._cast_contributions(contributions, weight=1)
+    
+    def _remove_scans_from_map(self, indices: List[int]):
+        """Subtract the recorded contributions of scans from the map"""
+        contributions = [self.scan_contributions.pop(idx) for idx in indices]
+        self._cast_contributions(contributions, weight=-1)
+    
+    def _scan_rays(self, pose: Pose2D, scan: LidarScan) -> ScanContribution:
+        """Map cells of the rays a scan casts from pose"""
         robot_mx, robot_my = self.map.world_to_map(pose.x, pose.y)
         
-        if not self.map.is_valid(robot_mx, robot_my):
+        valid_mask = scan.valid_mask()
+        ranges = scan.ranges[valid_mask]
+        beam_angles = pose.theta + scan.angles[valid_mask]
+        end_x = pose.x + ranges * np.cos(beam_angles)
+        end_y = pose.y + ranges * np.sin(beam_angles)
+        
+        # Same flooring as world_to_map
+        return ScanContribution(
+            pose=pose,
+            origin_mx=np.full(len(ranges), robot_mx, dtype=np.int32),
+            origin_my=np.full(len(ranges), robot_my, dtype=np.int32),
+            end_mx=np.floor((end_x - self.map.origin[0]) / self.map.resolution).astype(np.int32),
+            end_my=np.floor((end_y - self.map.origin[1]) / self.map.resolution).astype(np.int32)
+        )
+    
+    def _cast_contributions(self, contributions: List[ScanContribution], weight: int):
+        """Ray-cast recorded scan rays in one vectorized pass and apply them with weight"""
+        if not contributions:
             return
         
-        for range_val, angle in zip(scan.ranges, scan.angles):
-            if range_val <= 0 or range_val >= scan.max_range or np.isnan(range_val):
-                continue
-            
-            beam_angle = pose.theta + angle
-            end_x = pose.x + range_val * np.cos(beam_angle)
-            end_y = pose.y + range_val * np.sin(beam_angle)
-            
-            end_mx, end_my = self.map.world_to_map(end_x, end_y)
-            
-            ray_cells = self.ray_caster.get_line(robot_mx, robot_my, end_mx, end_my)
-            
-            for j, (mx, my) in enumerate(ray_cells):
-                if not self.map.is_valid(mx, my):
-                    continue
-                
-                if j < len(ray_cells) - 1:
-                    self.map.update_cell(mx, my, occupied=False)
-                else:
-                    self.map.update_cell(mx, my, occupied=True)
+        origin_mx = np.concatenate([c.origin_mx for c in contributions])
+        origin_my = np.concatenate([c.origin_my for c in contributions])
+        end_mx = np.concatenate([c.end_mx for c in contributions])
+        end_my = np.concatenate([c.end_my for c in contributions])
+        
+        if self.map_rasterizer is not None and len(end_mx) >= self.parallel_min_rays:
+            # Summed hit counts from the workers, applied per touched cell
+            mx0, my0, occ, free = self.map_rasterizer.count(origin_mx, origin_my, end_mx, end_my)
+            my, mx = np.nonzero(occ | free)
+            self.map.add_counts(mx + mx0, my + my0, occ[my, mx], free[my, mx], weight)
+            return
+        
+        # Last cell of each ray is the hit (occupied), the rest are free
+        for cells_x, cells_y, is_end in self.ray_caster.iter_lines(origin_mx, origin_my, end_mx, end_my):
+            self.map.update_cells(cells_x, cells_y, is_end, weight)
     
-    def _rebuild_map(self):
-        """Rebuild the entire map from scratch using optimized poses"""
-        print("Rebuilding map with optimized poses...")
+    def _rebuild_map(self, full: bool = False):
+        """
+        Bring the map in line with the optimized poses
+        
+        Only scans whose pose moved beyond the map tolerances since they
+        were rasterized are subtracted and cast again, unless full is set.
+        The candidates are the poses the last optimization wrote plus the
+        scans not yet in the map, so a window solve costs O(window).
+        """
+        poses = self.pose_graph.poses
+        
+        if self.submaps is not None:
+            # Submaps are re-placed lazily in get_map
+            if full:
+                self.submaps.render(poses, full=True)
+            return
         
-        # Clear the map
-        self.map.log_odds = np.zeros((self.map.height, self.map.width))
+        if full:
+            self.map.clear()
+            self.scan_contributions.clear()
+            moved = list(range(len(poses)))
+        else:
+            candidates = self._unmapped_scans.union(self.pose_graph.last_updated.tolist())
+            moved = [idx for idx in sorted(candidates)
+                     if idx not in self.scan_contributions or
+                     pose_moved(self.scan_contributions[idx].pose, poses[idx],
+                                self.map_translation_tolerance, self.map_rotation_tolerance)]
+            self._remove_scans_from_map([idx for idx in moved if idx in self.scan_contributions])
         
-        # Reprocess all scans with optimized poses
-        for pose, scan in zip(self.pose_graph.poses, self.pose_graph.scans):
-            self._update_map_with_scan(pose, scan)
+        print(f"Rebuilding map with optimized poses ({len(moved)} of {len(poses)} scans re-cast)...")
+        self._update_map_with_scans(moved)
     
     def optimize_full(self):
         """Perform a full pose graph optimization"""
@@ -546,35 +2248,54 @@ class GraphSLAM:
         if success:
             print("Full optimization successful!")
             self._rebuild_map()
+            self._rebuild_local_map()
         else:
             print("Full optimization failed!")
         
         return success
     
-    def get_map(self) -> np.ndarray:
-        """Get the current occupancy grid map"""
-        return self.map.get_occupancy_grid()
+    def get_map(self, explored: bool = False) -> np.ndarray:
+        """
+        Get the current occupancy grid map
+        
+        Args:
+            explored: Cover everything mapped so far, not just the configured
+                map size (see OccupancyGridMap.get_extent for its placement)
+        """
+        if self.submaps is not None:
+            self.submaps.render(self.pose_graph.poses)
+        return self.map.get_occupancy_grid(explored)
     
     def get_poses(self) -> List[Pose2D]:
         """Get all poses in the graph"""
         return self.pose_graph.poses
     
+    def get_loop_closure_stats(self) -> Dict[str, float]:
+        """Candidate counts and lookup times of the loop-closure spatial index, and source downsampling"""
+        index = self.pose_graph.spatial_index
+        downsampler = self.loop_closure_downsampler
+        return {
+            'source_reduction': downsampler.reduction if downsampler is not None else 0.0,
+            'queries': index.num_queries,
+            'last_candidates': index.last_candidates,
+            'mean_candidates': index.total_candidates / max(index.num_queries, 1),
+            'last_lookup_time': index.last_lookup_time,
+            'total_lookup_time': index.total_lookup_time,
+        }
+    
     def get_constraints(self) -> List[PoseConstraint]:
         """Get all constraints in the graph"""
-        return self.pose_graph.constraints
+        return list(self.pose_graph.constraints)
     
     def visualize(self, show_trajectory: bool = True, show_constraints: bool = True):
         """Visualize the map, trajectory, and constraints"""
-        occupancy = self.get_map()
+        occupancy = self.get_map(explored=True)
         
         fig, (ax1, ax2) = plt.subplots(1, 2, figsize=(16, 8))
         
         # Plot 1: Occupancy map with trajectory
         ax1.imshow(occupancy, cmap='gray_r', origin='lower',
-                   extent=[self.map.origin[0],
-                          self.map.origin[0] + self.map.width * self.map.resolution,
-                          self.map.origin[1],
-                          self.map.origin[1] + self.map.height * self.map.resolution])
+                   extent=self.map.get_extent(explored=True))
         
         if show_trajectory and len(self.pose_graph.poses) > 0:
             trajectory_x = [p.x for p in self.pose_graph.poses]
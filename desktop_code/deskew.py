@@ -0,0 +1,58 @@
+import numpy as np
+import se2
+
+# Motion compensation for scans taken while the robot moves. The odometer
+# reports a pose at time t together with its rates (xr, yr, hr); the pose at
+# any other time is extrapolated linearly from it, for all beams at once.
+
+
+def scan_arrays(scan_data):
+    """
+    Angles, distances and timestamps of a scan as arrays
+    scan_data: list of {'a': , 'd': , 't': } dictionaries
+    """
+    count = len(scan_data)
+    angle = np.fromiter((meas['a'] for meas in scan_data), dtype=np.float64, count=count)
+    dist = np.fromiter((meas['d'] for meas in scan_data), dtype=np.float64, count=count)
+    t = np.fromiter((meas['t'] for meas in scan_data), dtype=np.float64, count=count)
+    return angle, dist, t
+
+
+def pose_at(robot_pose, t):
+    """
+    Robot pose extrapolated to time(s) t
+    robot_pose: {"x": , "y": , "h": , "t": , "xr": , "yr": , "hr": } dict
+    Returns (x, y, h), arrays when t is an array (one pose per beam)
+    """
+    time_diff = t - robot_pose["t"]
+    x = robot_pose["x"] + robot_pose["xr"] * time_diff
+    y = robot_pose["y"] + robot_pose["yr"] * time_diff
+    h = robot_pose["h"] + robot_pose["hr"] * time_diff
+    return x, y, h
+
+
+def deskew(robot_pose, angle, dist, t, ref_time=None, angle_sign=1.0):
+    """
+    Re-express every beam from the robot pose at ref_time (default mid-scan)
+
+    Each beam is placed from the pose at its own timestamp, at heading
+    h + angle_sign * angle, and measured again from the reference pose, so a
+    scan taken while moving can be treated as if taken from a single pose.
+
+    Returns:
+        (angle, dist, (x, y, h)) with the corrected beams and the reference pose
+    """
+    if ref_time is None:
+        ref_time = t[len(t) // 2]
+    bx, by, bh = pose_at(robot_pose, t)
+    ref = pose_at(robot_pose, ref_time)
+
+    # Beam endpoints in the world frame, then in the reference frame
+    beam_angle = bh + angle_sign * angle
+    end = np.column_stack([bx + dist * np.cos(beam_angle), by + dist * np.sin(beam_angle)])
+    local = se2.transform_points(se2.inverse(ref), end)
+    # Keep each angle on the same branch as the measured one; beams without
+    # a return (zero or NaN distance) are passed through
+    valid = dist > 0
+    corrected = angle + se2.normalize_angle(angle_sign * np.arctan2(local[:, 1], local[:, 0]) - angle)
+    return (np.where(valid, corrected, angle), np.where(valid, np.hypot(local[:, 0], local[:, 1]), dist), ref)
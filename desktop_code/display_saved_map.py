@@ -16,8 +16,10 @@ def p_from_log_odds(l):
     return 1.0 - (1.0 / (1.0 + np.exp(l)))
 
 def plot_map(np_map):
-    # Convert log-odds back to probability for visualization
-    prob_map = p_from_log_odds(saved_map)
+    # Convert log-odds back to probability for visualization (a saved
+    # snapshot has no tiles to track, so this is one pass over the map;
+    # live maps export through Build_OGM.get_probability instead)
+    prob_map = p_from_log_odds(np_map)
     plt.imshow(prob_map.T, cmap="Greys", origin="lower",
                extent=[LFT, RGT, BOT, TOP])
 
@@ -0,0 +1 @@
+../SLAM/desktop_path.py
\ No newline at end of file
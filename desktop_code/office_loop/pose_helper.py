@@ -3,6 +3,9 @@
 import numpy as np
 import math
 
+import desktop_path  # noqa: F401 (puts desktop_code/ on sys.path)
+import se2
+
 def pose_to_hom_matrix(x, y, theta):
     """Converts a 2D pose (x, y, theta) to a 3x3 homogeneous transformation matrix."""
     c = math.cos(theta)
@@ -30,28 +33,16 @@ def calculate_relative_pose(pose1, pose2):
     Args:
         pose1 (tuple): The first pose (x1, y1, theta1) in world coordinates.
         pose2 (tuple): The second pose (x2, y2, theta2) in world coordinates.
+        Either may also be an (N, 3) array of poses.
 
     Returns:
-        tuple: The relative pose (dx, dy, dtheta).
+        tuple: The relative pose (dx, dy, dtheta), or an (N, 3) array for arrays of poses.
     """
-    x1, y1, theta1 = pose1
-    x2, y2, theta2 = pose2
-
-    # 1. Convert poses to homogeneous transformation matrices
-    T_w1 = pose_to_hom_matrix(x1, y1, theta1) # World to pose1 transform
-    T_w2 = pose_to_hom_matrix(x2, y2, theta2) # World to pose2 transform
-
-    # 2. Calculate the inverse of the first matrix (T_w1^-1)
-    # The inverse is used to transform a point from world frame to pose1's frame
-    T_1w = np.linalg.inv(T_w1)
-
-    # 3. Calculate the relative transformation T_12 = T_1w * T_w2
-    # This matrix T_12 represents the transformation from pose1's frame to pose2's frame
-    T_12 = np.dot(T_1w, T_w2)
-
-    # 4. Convert the resulting matrix back to pose parameters
-    dx, dy, dtheta = hom_matrix_to_pose(T_12)
-
+    # Closed form of inv(T_w1) * T_w2, no matrix inverse needed
+    relative = se2.relative(pose1, pose2)
+    if relative.ndim > 1:
+        return relative
+    dx, dy, dtheta = relative.tolist()
     return dx, dy, dtheta
 
 if __name__ == "__main__":
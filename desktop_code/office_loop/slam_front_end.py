@@ -1,64 +1,173 @@
 import numpy as np
 from scipy.spatial import KDTree
 
-def estimate_normals(points, k=5):
+def estimate_normals(points, k=5, ordered=False):
     """
-    Estimate 2D normals using local PCA and KDTree.
-    Points shape: (N, 2) # efficient access to each point
+    Estimate 2D normals using local PCA, for all points at once.
+    Points shape: (N, 2)
+    ordered: points are in scan (angle) order, so the k neighbours are
+        taken from the surrounding indices and no KDTree is built.
+    Returns unit normals shape (N, 2), the eigenvector of the smallest
+    eigenvalue of each neighbourhood covariance (sign is arbitrary).
     """
-    tree = KDTree(points)
-    normals = np.zeros_like(points)
-    for i, p in enumerate(points):
-        _, idx = tree.query(p, k=k)
-        neighbors = points[idx]
-        cov = np.cov(neighbors.T)
-        evals, evecs = np.linalg.eigh(cov)
-        normals[i] = evecs[:, 0]  # Eigenvector with smallest eigenvalue
-    return normals
+    n = len(points)
+    k = min(k, n)
+    if n < 2:
+        return np.tile([1.0, 0.0], (n, 1))
+    if ordered:
+        # Window of k consecutive indices around each point, shifted at the ends
+        start = np.clip(np.arange(n) - k // 2, 0, n - k)
+        idx = start[:, None] + np.arange(k)
+    else:
+        _, idx = KDTree(points).query(points, k=k)
+    neighbors = points[idx]  # (N, k, 2)
 
-def point_to_plane_icp(source, target, init_pose=(0,0,0), max_iter=20):
+    # Closed-form 2x2 covariance [[a, b], [b, c]] per point
+    centered = neighbors - neighbors.mean(axis=1, keepdims=True)
+    a = np.sum(centered[:, :, 0] ** 2, axis=1)
+    b = np.sum(centered[:, :, 0] * centered[:, :, 1], axis=1)
+    c = np.sum(centered[:, :, 1] ** 2, axis=1)
+
+    # Major axis is at angle phi, the normal is perpendicular to it
+    phi = 0.5 * np.arctan2(2 * b, a - c)
+    return np.column_stack([-np.sin(phi), np.cos(phi)])
+
+def point_to_line_icp(source, target, init_pose=(0, 0, 0), max_iter=20, tolerance=1e-4,
+                      max_distance=np.inf, max_normal_angle=None,
+                      target_normals=None, target_tree=None, source_normals=None):
     """
-    Apply 2D Point-to-Plane ICP algorithm to source points.
+    Vectorized 2D point-to-line ICP with correspondence rejection.
     Args:
         source (np.ndarray): Array of points shape (N, 2)
         target (np.ndarray): Array of points shape (M, 2)
-    Returns: SE(2) transformation [x, y, theta].
+        init_pose: Initial SE(2) guess [x, y, theta]
+        max_distance: Reject pairs farther apart than this
+        max_normal_angle: Reject pairs whose normals differ by more than this (radians)
+        target_normals, target_tree, source_normals: Precomputed, if available
+    Returns: (pose [x, y, theta], fitness, converged), fitness is the
+        fraction of source points with an accepted correspondence.
     """
-    # 1. Estimate target normals
-    target_normals = estimate_normals(target)
-    target_tree = KDTree(target)
-    
+    if target_normals is None:
+        target_normals = estimate_normals(target)
+    if target_tree is None:
+        target_tree = KDTree(target)
+    if max_normal_angle is None:
+        source_normals = None
+    else:
+        if source_normals is None:
+            source_normals = estimate_normals(source)
+        min_cos = np.cos(max_normal_angle)
+
     curr_pose = np.array(init_pose, dtype=float)
-    
+    fitness = 0.0
+
     for _ in range(max_iter):
         # Transform source points by current pose
         c, s = np.cos(curr_pose[2]), np.sin(curr_pose[2])
         R = np.array([[c, -s], [s, c]])
-        t = curr_pose[:2].reshape(2, 1)
-        src_transformed = (R @ source.T + t).T
-        
-        # 2. Data Association (Nearest Neighbor)
-        dist, indices = target_tree.query(src_transformed)
-        matched_target = target[indices]
-        matched_normals = target_normals[indices]
-        
-        # 3. Solve Point-to-Plane linear system: (p_i' - q_i)·n_i ≈ 0
-        # where p_i' is source point moved by delta (dx, dy, dtheta)
-        A = []
-        b = []
-        for i in range(len(src_transformed)):
-            p = src_transformed[i]
-            q = matched_target[i]
-            n = matched_normals[i]
-            
-            # Jacobian for SE(2): [1, 0, -py], [0, 1, px]
-            J = np.array([[1, 0, -p[1]], [0, 1, p[0]]])
-            row = n.T @ J
-            A.append(row)
-            b.append(n.T @ (q - p))
-            
-        dx = np.linalg.lstsq(np.array(A), np.array(b), rcond=None)[0]
-        curr_pose += dx
-        if np.linalg.norm(dx) < 1e-4: break
-            
-    return curr_pose
+        src_transformed = source @ R.T + curr_pose[:2]
+
+        # Data association (nearest neighbor), then rejection
+        dist, indices = target_tree.query(src_transformed, distance_upper_bound=max_distance)
+        valid = np.isfinite(dist)
+        if source_normals is not None:
+            # Normals have no sign, so compare |cos| of the angle between them
+            rotated_normals = source_normals @ R.T
+            valid[valid] = np.abs(np.sum(rotated_normals[valid] *
+                                         target_normals[indices[valid]], axis=1)) >= min_cos
+        fitness = np.count_nonzero(valid) / len(source)
+        if np.count_nonzero(valid) < 3:
+            return curr_pose, 0.0, False
+
+        p = src_transformed[valid]
+        q = target[indices[valid]]
+        n = target_normals[indices[valid]]
+
+        # Point-to-line system (p_i' - q_i)·n_i ≈ 0 for a small motion
+        # (dx, dy, dtheta) of the transformed points: rows n^T [[1, 0, -py], [0, 1, px]]
+        A = np.column_stack([n[:, 0], n[:, 1], n[:, 1] * p[:, 0] - n[:, 0] * p[:, 1]])
+        b = np.sum(n * (q - p), axis=1)
+        dx = np.linalg.lstsq(A, b, rcond=None)[0]
+
+        # Apply the increment on the left: rotate by dtheta, then translate
+        cd, sd = np.cos(dx[2]), np.sin(dx[2])
+        curr_pose[:2] = np.array([[cd, -sd], [sd, cd]]) @ curr_pose[:2] + dx[:2]
+        curr_pose[2] = (curr_pose[2] + dx[2] + np.pi) % (2 * np.pi) - np.pi
+        if np.linalg.norm(dx) < tolerance:
+            return curr_pose, fitness, True
+
+    return curr_pose, fitness, False
+
+def point_to_plane_icp(source, target, init_pose=(0,0,0), max_iter=20):
+    """
+    Apply 2D Point-to-Plane ICP algorithm to source points.
+    Args:
+        source (np.ndarray): Array of points shape (N, 2)
+        target (np.ndarray): Array of points shape (M, 2)
+    Returns: SE(2) transformation [x, y, theta].
+    """
+    return point_to_line_icp(source, target, init_pose, max_iter)[0]
+
+class ScanDownsampler:
+    """
+    Thin out a 2D scan before matching: range-adaptive angular decimation,
+    then a voxel-grid filter, then an optional cap on the point count.
+    Points must be in the sensor frame, in beam order; the points kept are
+    original measurements, in their original order.
+    """
+
+    def __init__(self, min_spacing=0.0, voxel_size=0.0, max_points=None):
+        self.min_spacing = min_spacing  # Arc length (m) between kept beams, 0 disables
+        self.voxel_size = voxel_size  # Voxel edge (m), one point per voxel, 0 disables
+        self.max_points = max_points  # None for no cap
+
+        # Reduction statistics
+        self.last_input = 0
+        self.last_output = 0
+        self.total_input = 0
+        self.total_output = 0
+
+    @property
+    def reduction(self):
+        """Fraction of all input points removed so far"""
+        return 1.0 - self.total_output / max(self.total_input, 1)
+
+    def filter(self, points, return_indices=False):
+        """
+        Downsample points shape (N, 2).
+        Returns the kept points, and their indices into points if return_indices.
+        """
+        keep = np.arange(len(points))
+
+        if self.min_spacing > 0 and len(keep) > 1:
+            # Keep a beam each time the arc swept along the scan passes
+            # another min_spacing; near obstacles many beams share one step
+            ranges = np.hypot(points[:, 0], points[:, 1])
+            angles = np.arctan2(points[:, 1], points[:, 0])
+            dangle = np.abs((np.diff(angles) + np.pi) % (2 * np.pi) - np.pi)
+            arc = np.concatenate([[0.0], np.cumsum(ranges[1:] * dangle)])
+            step = np.floor(arc / self.min_spacing)
+            keep = keep[np.concatenate([[True], step[1:] != step[:-1]])]
+
+        if self.voxel_size > 0 and len(keep) > 0:
+            # First point (in beam order) of each occupied voxel
+            voxels = np.floor(points[keep] / self.voxel_size).astype(np.int64)
+            _, first = np.unique(voxels, axis=0, return_index=True)
+            keep = keep[np.sort(first)]
+
+        if self.max_points is not None and len(keep) > self.max_points:
+            # Evenly spaced along the scan
+            keep = keep[np.linspace(0, len(keep) - 1, self.max_points).astype(int)]
+
+        self.last_input = len(points)
+        self.last_output = len(keep)
+        self.total_input += self.last_input
+        self.total_output += self.last_output
+        if return_indices:
+            return points[keep], keep
+        return points[keep]
+
+    def report(self):
+        """One-line summary of the reduction so far"""
+        return (f"downsampled {self.total_input} -> {self.total_output} points "
+                f"({100 * self.reduction:.1f}% removed)")
@@ -121,6 +121,7 @@ def explore_data(data):
 if __name__ == "__main__":
     data = load_data()
     prev_pose = (0, 0, 0)  # Initial value
+    downsampler = slam_front_end.ScanDownsampler(min_spacing=0.02, voxel_size=0.05)
 
     for n in range(0, len(data)-2, 2):
         print(f"scan number = {n+2}")
@@ -134,8 +135,10 @@ if __name__ == "__main__":
         diff_pose = ph.calculate_relative_pose(prev_pose, synced_pose)
         prev_pose = synced_pose
         print(f"{diff_pose = }")
-        icp_pose = slam_front_end.point_to_plane_icp(curr_scan.T, prev_scan.T, diff_pose)
+        source = downsampler.filter(curr_scan.T)
+        icp_pose = slam_front_end.point_to_plane_icp(source, prev_scan.T, diff_pose)
         print(f"{icp_pose = }")
+        print(downsampler.report())
         print()
         latest_scan = local_to_world(curr_scan, synced_pose)
         plot_data(prior_scan, latest_scan, "prior scan", "current scan")
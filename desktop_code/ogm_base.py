@@ -0,0 +1,136 @@
+import numpy as np
+import math
+from raycast import BatchRayCaster, shared_ray_templates
+from tiled_grid import TiledGrid, CachedView, FixedPoint
+
+
+class TiledLogOddsMap:
+    """
+    Log-odds occupancy grid in tiles allocated on first touch, indexed [ix, iy]
+
+    Storage, dense exports, the probability cache and pickling shared by the
+    Build_OGM map builders; subclasses map positions to cells and turn scans
+    into rays for _apply_rays.
+    """
+
+    def __init__(self, width, height, resolution,
+                 orig_x_pos=0.5, orig_y_pos=0.5,
+                 p_occ=0.7, p_free=0.3, p_prior=0.5, tile_size=64,
+                 log_odds_dtype=np.float64, l_limit=5.0, ray_templates=False):
+        self.resolution = resolution
+        self.width = width
+        self.height = height
+        self.orig_x_pos = orig_x_pos  # origin position, see the subclass's pos_to_index
+        self.orig_y_pos = orig_y_pos
+        
+        # Initialize grid dimensions (the window exported as data, the
+        # map itself grows as needed)
+        self.nx = int(round(width / resolution))
+        self.ny = int(round(height / resolution))
+        
+        # Log-odds values for updates
+        self.l_occ = self._log_odds(p_occ)
+        self.l_free = self._log_odds(p_free)
+        self.l_prior = self._log_odds(p_prior)
+        
+        # Compact storage: an integer log_odds_dtype (np.int16 or np.int8)
+        # keeps fixed-point log-odds, saturating at +/- l_limit
+        self.codec = FixedPoint(log_odds_dtype, l_limit)
+
+        # Map tiles allocated on first touch, cells start at prior log-odds
+        self.tiles = TiledGrid(tile_size, {'log_odds': (self.codec.dtype, self.codec.encode(self.l_prior))})
+        # ray_templates copies rays from the process-wide template cache
+        # instead of computing them (pays off when beams repeat, e.g. a slow robot)
+        self.ray_caster = BatchRayCaster(templates=shared_ray_templates() if ray_templates else None)
+        self._init_probability_view()
+
+    def _init_probability_view(self):
+        # Occupancy probabilities (float32, 4 bytes per cell once exported),
+        # recomputed only for tiles changed since the last export
+        self.probability_view = CachedView(self.tiles, 'log_odds', self._p_from_stored, np.float32)
+
+    @property
+    def data(self):
+        """Dense float64 log-odds of the nx x ny window, indexed [ix, iy]"""
+        return self.codec.decode(self.tiles.to_dense('log_odds', 0, 0, (self.nx, self.ny)))
+
+    def _window(self, explored):
+        """Cell window (ix0, iy0, ix1, iy1) of a dense export"""
+        ix0, iy0, ix1, iy1 = 0, 0, self.nx, self.ny
+        if explored and self.tiles.num_tiles:
+            tx0, ty0, tx1, ty1 = self.tiles.bounds()
+            ix0, iy0 = min(ix0, tx0), min(iy0, ty0)
+            ix1, iy1 = max(ix1, tx1), max(iy1, ty1)
+        return ix0, iy0, ix1, iy1
+
+    def get_dense(self, explored=True):
+        """
+        Dense log-odds covering the window and, if explored, every mapped cell.
+        Returns (data, (ix0, iy0)), where data[0, 0] is cell (ix0, iy0).
+        """
+        ix0, iy0, ix1, iy1 = self._window(explored)
+        data = self.tiles.to_dense('log_odds', ix0, iy0, (ix1 - ix0, iy1 - iy0))
+        return self.codec.decode(data), (ix0, iy0)
+
+    def get_probability(self, explored=True):
+        """
+        Occupancy probabilities (float32) over the same window as get_dense.
+        The array is a read-only view of a cache that later updates change
+        in place; copy it to keep a snapshot.
+        """
+        ix0, iy0, ix1, iy1 = self._window(explored)
+        return self.probability_view.to_dense(ix0, iy0, (ix1 - ix0, iy1 - iy0)), (ix0, iy0)
+
+    def __getstate__(self):
+        # The probability cache is rebuilt on load
+        state = self.__dict__.copy()
+        state.pop('probability_view', None)
+        return state
+
+    def __setstate__(self, state):
+        # Maps pickled before tiling kept a dense data array,
+        # and ones before compact storage had no codec
+        data = state.pop('data', None)
+        state.setdefault('codec', FixedPoint(np.float64))
+        state.setdefault('ray_caster', BatchRayCaster())
+        self.__dict__.update(state)
+        if data is not None:
+            self.tiles = TiledGrid(64, {'log_odds': (np.float64, self.l_prior)})
+            self.tiles.from_dense('log_odds', 0, 0, data)
+        self._init_probability_view()
+
+    def _log_odds(self, p):
+        return math.log(p / (1 - p))
+
+    def _p_from_log_odds(self, l):
+        return 1.0 - (1.0 / (1.0 + np.exp(l)))
+
+    def _p_from_stored(self, stored):
+        return self._p_from_log_odds(self.codec.decode(stored))
+
+    def pos_to_index(self, x, y):
+        raise NotImplementedError
+
+    def pos_to_indices(self, x, y):
+        raise NotImplementedError
+
+    def _apply_rays(self, ix_src, iy_src, ix_tar, iy_tar):
+        """
+        Update the map with rays from source to target cells, using an inverse
+        sensor model: each ray's endpoint is 'occupied', the cells before it 'free'
+        """
+        # Cells of all rays at once (Bresenham, see raycast.bresenham_line)
+        free_delta = self.l_free - self.l_prior
+        occ_delta = self.l_occ - self.l_prior
+        ix, iy, is_end = self.ray_caster.get_lines(ix_src, iy_src, ix_tar, iy_tar)
+        deltas = np.where(is_end, occ_delta, free_delta)
+
+        # Apply the whole scan at once (in order, so repeated cells add up as before;
+        # compact storage saturates the per-scan sum of each cell)
+        address = self.tiles.address(ix, iy)
+        if self.codec.quantized:
+            deltas = deltas * self.codec.scale
+            self.tiles.add('log_odds', address, deltas, saturate=True, limits=self.codec.limits)
+        else:
+            self.tiles.add('log_odds', address, deltas)
+        self.tiles.touch(address)
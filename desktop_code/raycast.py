@@ -0,0 +1,232 @@
+import numpy as np
+from typing import Iterator, List, Optional, Tuple
+
+
+def bresenham_line(x0: int, y0: int, x1: int, y1: int) -> List[Tuple[int, int]]:
+    """
+    Cells of one ray by Bresenham's line algorithm, start and end included
+
+    Reference for the vectorized casters below (one Python step per cell).
+    """
+    cells = []
+    dx = abs(x1 - x0)
+    dy = abs(y1 - y0)
+    sx = 1 if x0 < x1 else -1
+    sy = 1 if y0 < y1 else -1
+    err = dx - dy
+    x, y = x0, y0
+
+    while True:
+        cells.append((x, y))
+        if x == x1 and y == y1:
+            break
+        e2 = 2 * err
+        if e2 > -dy:
+            err -= dy
+            x += sx
+        if e2 < dx:
+            err += dx
+            y += sy
+    return cells
+
+
+def _cast_lines(x0: np.ndarray, y0: np.ndarray,
+                x1: np.ndarray, y1: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Bresenham cells of every ray, see BatchRayCaster.get_lines"""
+    x0, y0, x1, y1 = np.broadcast_arrays(*(np.asarray(a, dtype=np.int64).ravel()
+                                            for a in (x0, y0, x1, y1)))
+
+    dx = np.abs(x1 - x0)
+    dy = np.abs(y1 - y0)
+    sx = np.where(x0 < x1, 1, -1)
+    sy = np.where(y0 < y1, 1, -1)
+    n_steps = np.maximum(dx, dy)
+    counts = n_steps + 1
+
+    # Step index k along each ray: a running count that restarts at every ray
+    ends = np.cumsum(counts)
+    k = np.ones(ends[-1] if len(ends) else 0, dtype=np.int64)
+    if len(k):
+        k[0] = 0
+        k[ends[:-1]] = -n_steps[:-1]
+        np.cumsum(k, out=k)
+
+    # Minor-axis offset (2 k minor + major - 1) // (2 major); ties are rounded
+    # down, as in the error-term loop. The float quotient of these integers
+    # is never close enough below an integer to round up, so it floors exactly
+    major = np.maximum(n_steps, 1)
+    m = k * np.repeat(2 * np.minimum(dx, dy), counts)
+    m += np.repeat(major - 1, counts)
+    m = (m / np.repeat(2.0 * major, counts)).astype(np.int64)
+
+    x_major = np.repeat(dx >= dy, counts)
+    cells_x = np.repeat(x0, counts) + np.repeat(sx, counts) * np.where(x_major, k, m)
+    cells_y = np.repeat(y0, counts) + np.repeat(sy, counts) * np.where(x_major, m, k)
+    is_end = np.zeros(len(k), dtype=bool)
+    is_end[ends - 1] = True
+    return cells_x, cells_y, is_end
+
+
+class RayTemplateCache:
+    """
+    Precomputed Bresenham rays, keyed by the integer offset (dx, dy) from start to end cell
+
+    Bresenham cells are translation invariant, so a ray is its template's
+    cell offsets plus the start cell. Templates live in one flat pool and a
+    dense table over all offsets up to max_length maps (dx, dy) to a pool
+    start, so a batch of rays is looked up and copied without a Python loop.
+    Longer rays are cast directly.
+
+    When the pool reaches max_cells, eviction "reset" drops all templates and
+    starts over, "freeze" keeps the cached ones and casts new rays directly.
+    """
+
+    def __init__(self, max_length: int = 256, max_cells: int = 4_000_000, eviction: str = "reset"):
+        if eviction not in ("reset", "freeze"):
+            raise ValueError(f"Unknown eviction policy: {eviction}")
+        if max_length >= np.iinfo(np.int16).max:
+            raise ValueError(f"max_length must fit int16 offsets, got {max_length}")
+        self.max_length = max_length
+        self.max_cells = max_cells
+        self.eviction = eviction
+        self.clear()
+
+    def clear(self):
+        """Drop all templates"""
+        width = 2 * self.max_length + 1
+        self.starts = np.full(width * width, -1, dtype=np.int64)  # (dx, dy) -> pool start
+        self.offsets = np.zeros((2, 0), dtype=np.int16)  # pool of cell offsets (x, y)
+        self.num_cells = 0
+        self.hits = 0
+        self.misses = 0
+        self.resets = 0
+
+    def __reduce__(self):
+        # The shared cache unpickles as the shared cache of the loading process
+        if self is _shared_templates:
+            return shared_ray_templates, ()
+        return super().__reduce__()
+
+    def __getstate__(self):
+        # Templates are rebuilt on demand, only the settings are pickled
+        return {'max_length': self.max_length, 'max_cells': self.max_cells, 'eviction': self.eviction}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.clear()
+
+    @property
+    def nbytes(self) -> int:
+        return self.starts.nbytes + self.offsets.nbytes
+
+    def _insert(self, keys: np.ndarray):
+        """Cast and store the templates of distinct keys"""
+        width = 2 * self.max_length + 1
+        dx = keys // width - self.max_length
+        dy = keys % width - self.max_length
+        cells_x, cells_y, _ = _cast_lines(0, 0, dx, dy)
+        if self.num_cells + len(cells_x) > self.max_cells:
+            if self.eviction == "freeze":
+                return
+            self.starts[:] = -1
+            self.num_cells = 0
+            self.resets += 1
+            if len(cells_x) > self.max_cells:
+                return
+        end = self.num_cells + len(cells_x)
+        if end > self.offsets.shape[1]:
+            # Grow the pool geometrically
+            pool = np.zeros((2, min(max(2 * self.offsets.shape[1], end, 65536), self.max_cells)), dtype=np.int16)
+            pool[:, :self.num_cells] = self.offsets[:, :self.num_cells]
+            self.offsets = pool
+        self.offsets[0, self.num_cells:end] = cells_x
+        self.offsets[1, self.num_cells:end] = cells_y
+        counts = np.maximum(np.abs(dx), np.abs(dy)) + 1
+        self.starts[keys] = self.num_cells + np.cumsum(counts) - counts
+        self.num_cells = end
+
+    def get_lines(self, x0: np.ndarray, y0: np.ndarray,
+                  x1: np.ndarray, y1: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Same cells as BatchRayCaster.get_lines, copied from the templates"""
+        x0, y0, x1, y1 = np.broadcast_arrays(*(np.asarray(a, dtype=np.int64).ravel()
+                                                for a in (x0, y0, x1, y1)))
+        dx = x1 - x0
+        dy = y1 - y0
+        counts = np.maximum(np.abs(dx), np.abs(dy)) + 1
+        if len(counts) == 0 or counts.max() > self.max_length + 1:
+            return _cast_lines(x0, y0, x1, y1)
+
+        width = 2 * self.max_length + 1
+        keys = (dx + self.max_length) * width + (dy + self.max_length)
+        starts = self.starts[keys]
+        missing = starts < 0
+        if missing.any():
+            new_keys = np.unique(keys[missing])
+            self.misses += len(new_keys)
+            self._insert(new_keys)
+            starts = self.starts[keys]
+            if (starts < 0).any():
+                return _cast_lines(x0, y0, x1, y1)
+        self.hits += len(keys) - int(missing.sum())
+
+        # Pool index of every cell: its template's start plus the step along the ray
+        ends = np.cumsum(counts)
+        index = np.repeat(starts - (ends - counts), counts)
+        index += np.arange(ends[-1])
+        cells_x = self.offsets[0, index] + np.repeat(x0, counts)
+        cells_y = self.offsets[1, index] + np.repeat(y0, counts)
+        is_end = np.zeros(len(index), dtype=bool)
+        is_end[ends - 1] = True
+        return cells_x, cells_y, is_end
+
+
+_shared_templates: Optional[RayTemplateCache] = None
+
+
+def shared_ray_templates() -> RayTemplateCache:
+    """Process-wide template cache, so all map builders reuse each other's rays"""
+    global _shared_templates
+    if _shared_templates is None:
+        _shared_templates = RayTemplateCache()
+    return _shared_templates
+
+
+class BatchRayCaster:
+    """Vectorized Bresenham ray casting for whole scans (or many scans) at once"""
+
+    def __init__(self, max_cells_per_batch: int = 2_000_000,
+                 templates: Optional[RayTemplateCache] = None):
+        # Upper bound on cells generated per chunk, keeps memory flat
+        # when a long trajectory is re-cast in one call
+        self.max_cells_per_batch = max_cells_per_batch
+        # Optional ray template cache (e.g. shared_ray_templates()), rays
+        # are then copied from templates instead of being computed
+        self.templates = templates
+
+    def get_lines(self, x0: np.ndarray, y0: np.ndarray,
+                  x1: np.ndarray, y1: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Compute the cells of every ray (x0, y0) -> (x1, y1) in one pass.
+        Cells match bresenham_line exactly, ray by ray.
+
+        Returns:
+            (cells_x, cells_y, is_end) flat arrays, is_end marks the last cell of each ray
+        """
+        if self.templates is not None:
+            return self.templates.get_lines(x0, y0, x1, y1)
+        return _cast_lines(x0, y0, x1, y1)
+
+    def iter_lines(self, x0: np.ndarray, y0: np.ndarray, x1: np.ndarray,
+                   y1: np.ndarray) -> Iterator[Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+        """Like get_lines, but yields chunks of about max_cells_per_batch cells each"""
+        x0, y0, x1, y1 = np.broadcast_arrays(*(np.asarray(a, dtype=np.int64).ravel()
+                                                for a in (x0, y0, x1, y1)))
+        if len(x1) == 0:
+            return
+
+        counts = np.maximum(np.abs(x1 - x0), np.abs(y1 - y0)) + 1
+        # Chunk boundaries (in rays) so each chunk stays under the cell budget
+        chunk_id = (np.cumsum(counts) - 1) // self.max_cells_per_batch
+        bounds = np.concatenate(([0], np.flatnonzero(np.diff(chunk_id)) + 1, [len(counts)]))
+        for lo, hi in zip(bounds[:-1], bounds[1:]):
+            yield self.get_lines(x0[lo:hi], y0[lo:hi], x1[lo:hi], y1[lo:hi])
@@ -0,0 +1,85 @@
+import numpy as np
+
+# SE(2) pose math on arrays of poses. A pose is (x, y, theta) and a batch is
+# an (N, 3) array; every function takes single poses or batches (one
+# broadcasts against many) and works in closed form, without 3x3 matrices.
+# Returned angles are wrapped to [-pi, pi).
+
+
+def normalize_angle(angle):
+    """Wrap angle(s) to [-pi, pi)"""
+    return (angle + np.pi) % (2 * np.pi) - np.pi
+
+
+def compose(a, b) -> np.ndarray:
+    """Poses a * b: b expressed in a's frame, moved to a's parent frame"""
+    a = np.asarray(a, dtype=np.float64)
+    b = np.asarray(b, dtype=np.float64)
+    c = np.cos(a[..., 2])
+    s = np.sin(a[..., 2])
+    return np.stack([a[..., 0] + c * b[..., 0] - s * b[..., 1],
+                     a[..., 1] + s * b[..., 0] + c * b[..., 1],
+                     normalize_angle(a[..., 2] + b[..., 2])], axis=-1)
+
+
+def inverse(p) -> np.ndarray:
+    """Inverse poses, so that compose(p, inverse(p)) is the identity"""
+    p = np.asarray(p, dtype=np.float64)
+    c = np.cos(p[..., 2])
+    s = np.sin(p[..., 2])
+    return np.stack([-c * p[..., 0] - s * p[..., 1],
+                     s * p[..., 0] - c * p[..., 1],
+                     normalize_angle(-p[..., 2])], axis=-1)
+
+
+def relative(a, b) -> np.ndarray:
+    """Pose of b in a's frame, inverse(a) * b"""
+    a = np.asarray(a, dtype=np.float64)
+    b = np.asarray(b, dtype=np.float64)
+    c = np.cos(a[..., 2])
+    s = np.sin(a[..., 2])
+    dx = b[..., 0] - a[..., 0]
+    dy = b[..., 1] - a[..., 1]
+    return np.stack([c * dx + s * dy,
+                     -s * dx + c * dy,
+                     normalize_angle(b[..., 2] - a[..., 2])], axis=-1)
+
+
+def transform_points(pose, points) -> np.ndarray:
+    """
+    Move (N, 2) points from the pose's frame to its parent frame
+
+    With an (M, 3) batch of poses the result is (M, N, 2), every point set
+    moved by every pose.
+    """
+    pose = np.asarray(pose, dtype=np.float64)
+    points = np.asarray(points, dtype=np.float64)
+    c = np.cos(pose[..., 2])[..., None]
+    s = np.sin(pose[..., 2])[..., None]
+    x = points[:, 0]
+    y = points[:, 1]
+    return np.stack([pose[..., 0, None] + c * x - s * y,
+                     pose[..., 1, None] + s * x + c * y], axis=-1)
+
+
+def to_matrix(p) -> np.ndarray:
+    """Homogeneous 3x3 matrices of poses, shape (..., 3, 3)"""
+    p = np.asarray(p, dtype=np.float64)
+    c = np.cos(p[..., 2])
+    s = np.sin(p[..., 2])
+    matrix = np.zeros(p.shape[:-1] + (3, 3))
+    matrix[..., 0, 0] = c
+    matrix[..., 0, 1] = -s
+    matrix[..., 1, 0] = s
+    matrix[..., 1, 1] = c
+    matrix[..., 0, 2] = p[..., 0]
+    matrix[..., 1, 2] = p[..., 1]
+    matrix[..., 2, 2] = 1.0
+    return matrix
+
+
+def from_matrix(matrix) -> np.ndarray:
+    """Poses of homogeneous 3x3 matrices, shape (..., 3)"""
+    matrix = np.asarray(matrix, dtype=np.float64)
+    return np.stack([matrix[..., 0, 2], matrix[..., 1, 2],
+                     np.arctan2(matrix[..., 1, 0], matrix[..., 0, 0])], axis=-1)
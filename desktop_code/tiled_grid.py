@@ -0,0 +1,288 @@
+import numpy as np
+from typing import Dict, Tuple
+
+
+class TiledGrid:
+    """
+    Unbounded 2D grid stored as fixed-size square tiles, allocated on first touch.
+
+    Cells are addressed by integer (a, b) coordinates, which may be negative.
+    Each tile gets a slot in one contiguous pool per layer, so a cell has a
+    flat address (slot * tile_size**2 + offset) that indexes layer(name)
+    directly, e.g. with np.add.at. Addresses stay valid until clear(), but
+    allocating tiles replaces the pools, so take layer() views afterwards.
+    """
+
+    def __init__(self, tile_size: int = 64, layers: Dict[str, Tuple[type, float]] = None):
+        if tile_size <= 0 or tile_size & (tile_size - 1):
+            raise ValueError(f"tile_size must be a power of two, got {tile_size}")
+        self.tile_size = tile_size
+        self.shift = tile_size.bit_length() - 1
+        self.layer_specs = dict(layers or {'value': (np.float64, 0.0)})  # name -> (dtype, fill)
+        self.clear()
+
+    def clear(self):
+        """Drop all tiles"""
+        self.slots: Dict[Tuple[int, int], int] = {}  # (tile_a, tile_b) -> slot
+        self.tile_coords = np.zeros((0, 2), dtype=np.int64)  # slot -> (tile_a, tile_b)
+        # Change counters for derived layers: per tile, and for the grid as a whole
+        self.versions = np.zeros(0, dtype=np.int64)
+        self.generation = getattr(self, 'generation', -1) + 1
+        self.pools = {name: np.full((0, self.tile_size, self.tile_size), fill, dtype=dtype)
+                      for name, (dtype, fill) in self.layer_specs.items()}
+
+    @property
+    def num_tiles(self) -> int:
+        return len(self.slots)
+
+    @property
+    def nbytes(self) -> int:
+        return sum(pool.nbytes for pool in self.pools.values())
+
+    def layer(self, name: str) -> np.ndarray:
+        """Flat view of a layer's pool, indexed by cell address"""
+        return self.pools[name].reshape(-1)
+
+    def _allocate(self, tile_a: int, tile_b: int) -> int:
+        slot = len(self.slots)
+        capacity = len(self.tile_coords)
+        if slot == capacity:
+            # Grow the pools geometrically, new tiles start at the fill value
+            capacity = max(2 * capacity, 16)
+            coords = np.zeros((capacity, 2), dtype=np.int64)
+            coords[:slot] = self.tile_coords
+            self.tile_coords = coords
+            versions = np.zeros(capacity, dtype=np.int64)
+            versions[:slot] = self.versions
+            self.versions = versions
+            for name, (dtype, fill) in self.layer_specs.items():
+                pool = np.full((capacity, self.tile_size, self.tile_size), fill, dtype=dtype)
+                pool[:slot] = self.pools[name][:slot]
+                self.pools[name] = pool
+        self.slots[(tile_a, tile_b)] = slot
+        self.tile_coords[slot] = (tile_a, tile_b)
+        return slot
+
+    def address(self, a: np.ndarray, b: np.ndarray, allocate: bool = True) -> np.ndarray:
+        """
+        Flat addresses of cells (a, b)
+
+        Args:
+            a, b: Integer cell coordinates
+            allocate: Create missing tiles; otherwise their cells get address -1
+        """
+        a = np.asarray(a, dtype=np.int64)
+        b = np.asarray(b, dtype=np.int64)
+        tile_a = a >> self.shift
+        tile_b = b >> self.shift
+        if a.size == 0:
+            return np.zeros(a.shape, dtype=np.int64)
+
+        # Look up each distinct tile once. Cells usually span a small box of
+        # tiles, so the distinct ones are found by counting over the box in
+        # linear time; otherwise by sorting the tile keys
+        a0, b0 = int(tile_a.min()), int(tile_b.min())
+        span_b = int(tile_b.max()) - b0 + 1
+        box = (int(tile_a.max()) - a0 + 1) * span_b
+        dense = box <= max(4096, a.size)
+        if dense:
+            local = (tile_a - a0) * span_b + (tile_b - b0)
+            keys = np.flatnonzero(np.bincount(local.ravel(), minlength=box))
+            distinct_a, distinct_b = keys // span_b + a0, keys % span_b + b0
+        else:
+            _, first, inverse = np.unique((tile_a << 32) + tile_b, return_index=True, return_inverse=True)
+            distinct_a, distinct_b = tile_a.flat[first], tile_b.flat[first]
+        slots = np.empty(len(distinct_a), dtype=np.int64)
+        for k, (ta, tb) in enumerate(zip(distinct_a.tolist(), distinct_b.tolist())):
+            slot = self.slots.get((ta, tb))
+            if slot is None:
+                slot = self._allocate(ta, tb) if allocate else -1
+            slots[k] = slot
+        if dense:
+            table = np.empty(box, dtype=np.int64)
+            table[keys] = slots
+            slot = table[local]
+        else:
+            slot = slots[inverse].reshape(a.shape)
+
+        mask = self.tile_size - 1
+        offset = ((a & mask) << self.shift) + (b & mask)
+        return np.where(slot >= 0, (slot << (2 * self.shift)) + offset, -1)
+
+    def add(self, name: str, address: np.ndarray, values, saturate: bool = False,
+            limits: Tuple[int, int] = None):
+        """
+        Add values at cell addresses (repeated addresses accumulate)
+
+        With saturate, an integer layer is clamped to limits (default: its
+        dtype range) instead of wrapping around; each cell's increments are
+        summed before clamping.
+        """
+        layer = self.layer(name)
+        if not saturate or layer.dtype.kind == 'f':
+            np.add.at(layer, address, values)
+            return
+        weights = np.broadcast_to(values, address.shape)
+        lo = int(address.min()) if address.size else 0
+        span = int(address.max()) - lo + 1 if address.size else 0
+        if span <= 4 * address.size:
+            # Compact address range: sum per cell without sorting (cells whose
+            # increments cancel out are left alone, clamping would not change them)
+            sums = np.bincount(address - lo, weights=weights, minlength=span)
+            cells = np.flatnonzero(sums)
+            sums = sums[cells]
+            cells += lo
+        else:
+            cells, inverse = np.unique(address, return_inverse=True)
+            sums = np.bincount(inverse, weights=weights, minlength=len(cells))
+        if limits is None:
+            info = np.iinfo(layer.dtype)
+            limits = (info.min, info.max)
+        layer[cells] = np.clip(layer[cells] + np.round(sums).astype(np.int64), *limits)
+
+    def touch(self, address: np.ndarray):
+        """Bump the version of the tiles holding these cell addresses"""
+        # Repeated tiles are bumped once (buffered fancy indexing), without sorting
+        self.versions[address >> (2 * self.shift)] += 1
+
+    def gather(self, name: str, a: np.ndarray, b: np.ndarray) -> np.ndarray:
+        """Values of cells (a, b), the fill value where no tile exists"""
+        address = self.address(a, b, allocate=False)
+        fill = self.layer_specs[name][1]
+        values = self.layer(name)[np.maximum(address, 0)]
+        return np.where(address >= 0, values, fill).astype(self.pools[name].dtype)
+
+    def bounds(self) -> Tuple[int, int, int, int]:
+        """Cell bounds (a_min, b_min, a_max + 1, b_max + 1) of the allocated tiles"""
+        if not self.slots:
+            return 0, 0, 0, 0
+        coords = self.tile_coords[:self.num_tiles]
+        lo = coords.min(axis=0) << self.shift
+        hi = (coords.max(axis=0) + 1) << self.shift
+        return int(lo[0]), int(lo[1]), int(hi[0]), int(hi[1])
+
+    def to_dense(self, name: str, a0: int, b0: int, shape: Tuple[int, int]) -> np.ndarray:
+        """Dense copy of cells [a0, a0 + shape[0]) x [b0, b0 + shape[1]) of a layer"""
+        dtype, fill = self.layer_specs[name]
+        out = np.full(shape, fill, dtype=dtype)
+        self.copy_tiles(self.pools[name], out, a0, b0, range(self.num_tiles))
+        return out
+
+    def copy_tiles(self, pool: np.ndarray, out: np.ndarray, a0: int, b0: int, slots):
+        """Copy the given tiles of a per-slot pool into out, a dense window starting at cell (a0, b0)"""
+        a1, b1 = a0 + out.shape[0], b0 + out.shape[1]
+        coords = self.tile_coords
+        for slot in slots:
+            # Overlap of this tile with the window
+            ta0, tb0 = int(coords[slot, 0]) << self.shift, int(coords[slot, 1]) << self.shift
+            lo_a, hi_a = max(ta0, a0), min(ta0 + self.tile_size, a1)
+            lo_b, hi_b = max(tb0, b0), min(tb0 + self.tile_size, b1)
+            if lo_a < hi_a and lo_b < hi_b:
+                out[lo_a - a0:hi_a - a0, lo_b - b0:hi_b - b0] = \
+                    pool[slot, lo_a - ta0:hi_a - ta0, lo_b - tb0:hi_b - tb0]
+
+    def from_dense(self, name: str, a0: int, b0: int, values: np.ndarray):
+        """Write a dense block into the grid, allocating only tiles that differ from the fill value"""
+        fill = self.layer_specs[name][1]
+        a, b = np.nonzero(values != fill)
+        address = self.address(a + a0, b + b0)
+        self.layer(name)[address] = values[a, b]
+
+
+class CachedView:
+    """
+    Cached elementwise function of TiledGrid layers, e.g. probabilities of log-odds
+
+    function gets one array per layer in layers (a name or a tuple of names).
+    Only tiles whose version moved since the last call (see TiledGrid.touch)
+    are recomputed, so whoever writes the layer must touch what it changed.
+    Dense windows are returned as read-only views of the cache without
+    copying; they change with it, so copy one to keep a snapshot.
+    """
+
+    def __init__(self, grid: TiledGrid, layers, function, dtype):
+        self.grid = grid
+        self.layers = (layers,) if isinstance(layers, str) else tuple(layers)
+        self.function = function  # Stored layer values -> view values
+        self.dtype = np.dtype(dtype)
+        fills = [np.full(1, fill, dtype=layer_dtype)
+                 for layer_dtype, fill in (grid.layer_specs[name] for name in self.layers)]
+        self.fill = np.asarray(function(*fills), dtype=self.dtype)[0]
+        self.reset()
+
+    def reset(self):
+        """Forget all cached tiles"""
+        size = self.grid.tile_size
+        self.pool = np.full((0, size, size), self.fill, dtype=self.dtype)
+        self._seen_versions = np.zeros(0, dtype=np.int64)  # Grid tile versions already applied
+        self._seen_generation = self.grid.generation
+        self._window = None  # (a0, b0, shape) of the cached dense window
+        self._dense = None
+        self.tiles_updated = 0
+
+    def update(self) -> np.ndarray:
+        """Recompute tiles that changed since the last call, returns their slots"""
+        grid = self.grid
+        if self._seen_generation != grid.generation:
+            # Grid was cleared, start over
+            self.reset()
+        num_tiles = grid.num_tiles
+        if len(self.pool) < num_tiles:
+            pool = np.full((len(grid.tile_coords),) + self.pool.shape[1:], self.fill, dtype=self.dtype)
+            pool[:len(self.pool)] = self.pool
+            self.pool = pool
+
+        # Tiles allocated since the last call count as changed
+        versions = grid.versions[:num_tiles]
+        seen = np.full(num_tiles, -1, dtype=np.int64)
+        seen[:len(self._seen_versions)] = self._seen_versions
+        changed = np.flatnonzero(versions != seen)
+        if len(changed):
+            self.pool[changed] = self.function(*(grid.pools[name][changed] for name in self.layers))
+            self._seen_versions = versions.copy()
+            self.tiles_updated += len(changed)
+        return changed
+
+    def to_dense(self, a0: int, b0: int, shape: Tuple[int, int]) -> np.ndarray:
+        """Read-only view of cells [a0, a0 + shape[0]) x [b0, b0 + shape[1])"""
+        changed = self.update()
+        window = (a0, b0, tuple(shape))
+        if window != self._window:
+            self._dense = np.full(shape, self.fill, dtype=self.dtype)
+            self.grid.copy_tiles(self.pool, self._dense, a0, b0, range(self.grid.num_tiles))
+            self._window = window
+        else:
+            self.grid.copy_tiles(self.pool, self._dense, a0, b0, changed.tolist())
+        view = self._dense.view()
+        view.flags.writeable = False
+        return view
+
+
+class FixedPoint:
+    """Fixed-point encoding of values in [-limit, limit] into a small integer dtype"""
+
+    def __init__(self, dtype=np.float64, limit: float = 5.0):
+        self.dtype = np.dtype(dtype)
+        self.limit = limit
+        # Float dtypes are stored as is
+        self.quantized = self.dtype.kind in 'iu'
+        self.scale = np.iinfo(self.dtype).max / limit if self.quantized else 1.0
+
+    @property
+    def limits(self) -> Tuple[int, int]:
+        """Stored range of a quantized codec, symmetric so that it decodes to +/- limit"""
+        top = int(np.iinfo(self.dtype).max)
+        return -top, top
+
+    def encode(self, values) -> np.ndarray:
+        """Values as stored (rounded and saturated when quantized)"""
+        if not self.quantized:
+            return np.asarray(values, dtype=self.dtype)
+        lo, hi = self.limits
+        return np.clip(np.round(np.asarray(values) * self.scale), lo, hi).astype(self.dtype)
+
+    def decode(self, stored) -> np.ndarray:
+        """Stored values back as float64"""
+        if not self.quantized:
+            return np.asarray(stored)
+        return np.asarray(stored, dtype=np.float64) / self.scale